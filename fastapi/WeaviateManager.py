@@ -2,9 +2,27 @@ import weaviate
 import torch
 import os
 import copy
+import functools
+import threading
+import time
+from collections import OrderedDict
 from typing import Union, List
 import numpy
 
+
+def invalidates_results(method):
+    """
+    Decorator for VectorManager methods that write to a collection: drop that collection's cached search results afterwards
+    """
+    @functools.wraps(method)
+    def wrapper(self, collection_name, *args, **kwargs):
+        try:
+            return method(self, collection_name, *args, **kwargs)
+        finally:
+            self._invalidate_results(collection_name)
+    return wrapper
+
+
 class VectorManager:
     TYPE_MAP = {
         "int":["int"],
@@ -23,7 +41,12 @@ class VectorManager:
     
     def __init__(self) -> None:
         """
-        Set up the connection
+        Set up the connection and the search result cache.
+        The cache holds up to RESULT_CACHE_SIZE responses (0 disables it) for RESULT_CACHE_TTL seconds (0 for no expiry).
+        Writes through this manager clear the cache of their collection. Writes from other processes (e.g. ingest.py)
+        cannot, so they show up once the cached responses expire.
+        Batched searches send up to SEARCH_BATCH_SIZE queries per GraphQL request.
+        A forked child (e.g. a preforked server worker) opens its own connection.
 
         INPUT: None
         ------------------------------------
@@ -31,8 +54,24 @@ class VectorManager:
         RETURNS: None
         ------------------------------------
         """
-        self._client = weaviate.Client(f"http://{os.environ.get('WEAVIATE_HOST')}:{os.environ.get('WEAVIATE_C_PORT')}")
+        self._connect()
+        os.register_at_fork(after_in_child=self._connect)
+        self._properties = {}
+        self._uuids = {}
+        self._uuids_dropped = 0 # number of maps dropped, to not store a map scanned before a drop
+        self._uuids_lock = threading.Lock()
+
+        self._results = OrderedDict() # (collection_name, query...) -> (created, response)
+        self._results_generation = {} # collection_name -> number of writes, to drop searches that raced a write
+        self._results_lock = threading.Lock()
+        self._results_size = int(os.environ.get('RESULT_CACHE_SIZE', 1024))
+        self._results_ttl = float(os.environ.get('RESULT_CACHE_TTL', 300))
+        self._search_batch_size = max(1, int(os.environ.get('SEARCH_BATCH_SIZE', 16)))
         
+    def _connect(self) -> None:
+        # Pooled HTTP connections must not be shared between processes
+        self._client = weaviate.Client(f"http://{os.environ.get('WEAVIATE_HOST')}:{os.environ.get('WEAVIATE_C_PORT')}")
+
     def _traverse_map(self, schema:dict) -> List:
         """
         Restructure the schema
@@ -65,6 +104,187 @@ class VectorManager:
                 return []
         return temp
         
+    def _get_properties(self, collection_name: str) -> List:
+        """
+        Return the property names of a collection, read from the schema once and cached
+
+        INPUT: 
+        ------------------------------------
+        collection_name:    Name of collection
+                            example shape:  'Faces'
+
+        RETURNS: 
+        ------------------------------------
+        List:               List of property names
+                            example: ['doc_id', 'text']
+        """
+        collection_name = collection_name.capitalize()
+        if collection_name not in self._properties:
+            schema = self._client.schema.get(collection_name)
+            self._properties[collection_name] = [prop['name'] for prop in schema['properties']]
+        return self._properties[collection_name]
+
+    def _hit2document(self, collection_name: str, hit: dict) -> dict:
+        """
+        Rebuild the object returned by data_object.get_by_id from a GraphQL Get result,
+        so search results keep the same shape as read_document
+
+        INPUT: 
+        ------------------------------------
+        collection_name:    Name of collection
+                            example shape:  'Faces'
+        hit:                One entry of a GraphQL Get result, with the properties and an _additional dict
+                            example: {
+                                'doc_id': '11',
+                                '_additional': {'id': '9d62d87b-bb17-4736-8714-e1455ffa2b01', 'creationTimeUnix': '1671076617122', ...}
+                            }
+
+        RETURNS: 
+        ------------------------------------
+        dict:               Dictionary in the same format as read_document
+                            example: {
+                                'response': {
+                                    'class': 'Faces',
+                                    'creationTimeUnix': 1671076617122,
+                                    'id': '9d62d87b-bb17-4736-8714-e1455ffa2b01',
+                                    'lastUpdateTimeUnix': 1671076617122,
+                                    'properties': {'doc_id': '11', 'new': '2'},
+                                    'vector': [0.5766745, 0.9341823, 0.7021697, 0.54776406, 0.013553977],
+                                    'vectorWeights': None
+                                }
+                            }
+        """
+        additional = hit.pop('_additional')
+        document = {
+            'class': collection_name,
+            'creationTimeUnix': int(additional['creationTimeUnix']),
+            'id': additional['id'],
+            'lastUpdateTimeUnix': int(additional['lastUpdateTimeUnix']),
+            'properties': hit,
+        }
+        if 'vector' in additional:
+            document['vector'] = additional['vector']
+        document['vectorWeights'] = None
+        return {'response': document}
+
+    def _vector_key(self, target_embedding: Union[list, numpy.ndarray, torch.Tensor]) -> bytes:
+        """
+        Hashable form of a query embedding for the result cache
+        """
+        if isinstance(target_embedding, torch.Tensor):
+            target_embedding = target_embedding.detach().cpu().numpy()
+        return numpy.asarray(target_embedding, dtype=numpy.float32).tobytes()
+
+    def _cached_results(self, key: tuple):
+        """
+        Look up a search response in the result cache
+
+        INPUT: 
+        ------------------------------------
+        key:                Tuple starting with the collection name, followed by everything the response depends on
+
+        RETURNS: 
+        ------------------------------------
+        tuple:              The cached response or None, and the collection's write generation to pass to _cache_results
+        """
+        with self._results_lock:
+            generation = self._results_generation.get(key[0], 0)
+            if key in self._results:
+                created, response = self._results[key]
+                if self._results_ttl <= 0 or time.time() - created <= self._results_ttl:
+                    self._results.move_to_end(key)
+                    return response, generation
+                del self._results[key]
+            return None, generation
+
+    def _cache_results(self, key: tuple, generation: int, response: dict) -> None:
+        """
+        Store a search response, unless the collection was written to since the search started
+        """
+        with self._results_lock:
+            if self._results_size <= 0 or self._results_generation.get(key[0], 0) != generation:
+                return
+            self._results[key] = (time.time(), response)
+            self._results.move_to_end(key)
+            while len(self._results) > self._results_size:
+                self._results.popitem(last=False)
+
+    def _invalidate_results(self, collection_name: str) -> None:
+        """
+        Drop the cached search results of a collection
+        """
+        collection_name = collection_name.capitalize()
+        with self._results_lock:
+            self._results_generation[collection_name] = self._results_generation.get(collection_name, 0) + 1
+            for key in [key for key in self._results if key[0] == collection_name]:
+                del self._results[key]
+
+    def _doc_uuid(self, collection_name: str, doc_id: str) -> str:
+        """
+        Derive the uuid of a new document deterministically from its collection and doc_id
+
+        INPUT: 
+        ------------------------------------
+        collection_name:    Name of collection
+                            example shape:  'Faces'
+        doc_id:              id of document
+                            example: '72671'
+
+        RETURNS: 
+        ------------------------------------
+        str:                uuid5 of the doc_id, namespaced by the collection name
+                            example: '1fbf7a0f-1904-4c21-afd8-6bda380e51fd'
+        """
+        return weaviate.util.generate_uuid5(doc_id, collection_name.capitalize())
+
+    def _get_uuid_index(self, collection_name: str) -> dict:
+        """
+        Return the doc_id to uuid map of a collection. The map is built with a single cursor scan
+        the first time a collection is touched, and kept up to date by this manager's CRUD methods.
+        Documents written by other processes (e.g. ingest.py) are not in the map: _exists looks them up
+        on a miss, and refresh_uuid_index rebuilds the map.
+
+        INPUT: 
+        ------------------------------------
+        collection_name:    Name of collection
+                            example shape:  'Faces'
+
+        RETURNS: 
+        ------------------------------------
+        dict:               Map of doc_id to uuid
+                            example: {
+                                '72671': '1fbf7a0f-1904-4c21-afd8-6bda380e51fd'
+                            }
+        """
+        collection_name = collection_name.capitalize()
+        with self._uuids_lock:
+            if collection_name in self._uuids:
+                return self._uuids[collection_name]
+            dropped = self._uuids_dropped
+        # Scan without the lock, so a slow scan doesn't hold up the other collections
+        index = {}
+        cursor = None
+        while True:
+            query = self._client.query.get(collection_name, ["doc_id"]).with_additional(["id"]).with_limit(1000)
+            if cursor is not None:
+                query = query.with_after(cursor)
+            res = query.do()
+            if 'errors' in res:
+                # Collection does not exist (yet), nothing to index
+                return index
+            page = res['data']['Get'][collection_name]
+            if len(page) == 0:
+                break
+            for document in page:
+                index[document['doc_id']] = document['_additional']['id']
+            cursor = page[-1]['_additional']['id']
+        with self._uuids_lock:
+            if self._uuids_dropped != dropped:
+                # A map was dropped during the scan, this one may be stale: use it once, rescan next time
+                return index
+            # Another thread may have finished the same scan first, everyone shares its map
+            return self._uuids.setdefault(collection_name, index)
+
     def _id2uuid(self, collection_name: str, doc_id: str) -> dict:
         """
         Convert doc_id to uuid
@@ -83,21 +303,14 @@ class VectorManager:
                                 'uuid': '1fbf7a0f-1904-4c21-afd8-6bda380e51fd'
                             }
         """
-        collection_name = collection_name.capitalize()
         if self._exists(collection_name, doc_id):
-            where_filter = {
-                'operator': 'Equal',
-                'valueText': doc_id,
-                'path': ["doc_id"]
-            }
-            query_result =  self._client.query.get(collection_name, ["doc_id", "_additional {id}"]).with_where(where_filter).do()
-            uuid = query_result['data']['Get'][collection_name][0]['_additional']['id']
-            return {'uuid': uuid}
+            return {'uuid': self._get_uuid_index(collection_name)[doc_id]}
         return {'errors': f'id: {doc_id} is not found'}
     
-    def _exists(self, collection_name: str, doc_id: str) -> bool:
+    def _exists(self, collection_name: str, doc_id: str, check_server: bool = True) -> bool:
         """
-        Convert doc_id to uuid
+        Check if a doc_id exists in a collection. A doc_id missing from the uuid index is looked up on the server
+        by its deterministic uuid, since the document may have been written by another process.
 
         INPUT: 
         ------------------------------------
@@ -105,23 +318,165 @@ class VectorManager:
                             example shape:  'Faces'
         doc_id:              id of document
                             example: "72671"
+        check_server:       Whether to look a doc_id missing from the index up on the server. Default is True
 
         RETURNS: 
         ------------------------------------
         bool:               If the doc_id exists in the collection
                             example: True or False
         """
-        collection_name = collection_name.capitalize()
-        where_filter = {
-            'operator': 'Equal',
-            'valueText': doc_id, # error is here ??
-            'path': ['doc_id']
-        }
-        response = self._client.query.get(collection_name, ["doc_id", "_additional {id}"]).with_where(where_filter).do()
-        if 'data' in response and len(response['data']['Get'][collection_name]) == 1:
+        index = self._get_uuid_index(collection_name)
+        if doc_id in index:
             return True
-        return False
+        if not check_server:
+            return False
+        uuid = self._doc_uuid(collection_name, doc_id)
+        try:
+            exists = self._client.data_object.exists(uuid, class_name=collection_name.capitalize())
+        except Exception:
+            return False
+        if exists:
+            index[doc_id] = uuid
+        return exists
+
+    def refresh_uuid_index(self, collection_name: str) -> None:
+        """
+        Drop the doc_id to uuid map of a collection, so it is rebuilt with the documents written since,
+        including those written by other processes
+
+        INPUT: 
+        ------------------------------------
+        collection_name:    Name of collection
+                            example shape:  'Faces'
 
+        RETURNS: None
+        ------------------------------------
+        """
+        with self._uuids_lock:
+            self._uuids.pop(collection_name.capitalize(), None)
+            self._uuids_dropped += 1
+
+    def _near_vector_search(self, collection_name: str, target_embedding: Union[list, numpy.ndarray, torch.Tensor], top_k: int, with_vector: bool, offset: int, overfetch: int) -> dict:
+        """
+        Build the near vector query of get_top_k, as a search for _search
+        """
+        key = (collection_name, 'near_vector', self._vector_key(target_embedding), top_k, with_vector, offset, overfetch)
+        query_vector = {'vector': target_embedding, 'certainty': 0.7}
+        additional = ["id", "certainty", "creationTimeUnix", "lastUpdateTimeUnix"] + (["vector"] if with_vector else [])
+        # Fetch the documents in the same query instead of one read_document per hit
+        query = (
+            self._client.query
+               .get(collection_name, self._get_properties(collection_name))
+               .with_near_vector(query_vector)
+               .with_additional(additional)
+               .with_limit(top_k * overfetch)
+               .with_offset(offset)
+            )
+        return {'key': key, 'collection_name': collection_name, 'query': query, 'top_k': top_k, 'score_field': 'certainty', 'result_field': 'certainty'}
+
+    def _hybrid_search(self, collection_name: str, query_string: str, target_embedding: Union[list, numpy.ndarray, torch.Tensor], top_k: int, alpha: float, with_vector: bool, offset: int, overfetch: int) -> dict:
+        """
+        Build the query of get_top_k_by_hybrid, as a search for _search.
+        With alpha 0 or 1 only one side of the hybrid search has weight, so a plain bm25 or near vector query is built instead.
+        """
+        # Only the side with weight is part of the key, e.g. pure keyword searches are shared by every embedding
+        key = (
+            collection_name, 'hybrid',
+            query_string if alpha < 1 else None,
+            self._vector_key(target_embedding) if alpha > 0 else None,
+            top_k, alpha, with_vector, offset, overfetch
+        )
+        score_field = "certainty" if alpha >= 1 else "score"
+        additional = ["id", score_field, "creationTimeUnix", "lastUpdateTimeUnix"] + (["vector"] if with_vector else [])
+        # Fetch the documents in the same query instead of one read_document per hit
+        query = self._client.query.get(collection_name, self._get_properties(collection_name))
+        if alpha <= 0:
+            query = query.with_bm25(query_string, properties=["text"])
+        elif alpha >= 1:
+            query = query.with_near_vector({'vector': target_embedding})
+        else:
+            query = query.with_hybrid(
+                query_string,
+                vector=target_embedding[0].tolist(), # with_hybrid wants the vector as a list
+                alpha=alpha,
+                properties = ["text"]
+            )
+        query = (
+            query
+               .with_additional(additional)
+               .with_limit(top_k * overfetch)
+               .with_offset(offset)
+               .with_autocut(2)
+            )
+        return {'key': key, 'collection_name': collection_name, 'query': query, 'top_k': top_k, 'score_field': score_field, 'result_field': 'score'}
+
+    def _search(self, searches: List[dict], batch_size: int = None) -> List[dict]:
+        """
+        Run searches built by _near_vector_search or _hybrid_search. Cached responses are reused, the other searches
+        are sent batch_size at a time (SEARCH_BATCH_SIZE by default) in one GraphQL request each, under their own alias.
+
+        INPUT: 
+        ------------------------------------
+        searches:           List of searches, each with the result cache key, the collection name, the GetBuilder query,
+                            the number of hits to keep, the _additional field holding the score and the result field to return it in
+                            example: [{'key': (...), 'collection_name': 'Faces', 'query': GetBuilder, 'top_k': 10, 'score_field': 'certainty', 'result_field': 'certainty'}]
+        batch_size:         Maximum number of searches per request
+                            example: 16
+
+        RETURNS: 
+        ------------------------------------
+        List:               One dictionary per search, in the same order and format as get_top_k
+                            example: [{response: [...]}]
+        """
+        responses = [None] * len(searches)
+        pending = [] # (index, write generation) of the searches to send
+        for i, search in enumerate(searches):
+            cached, generation = self._cached_results(search['key'])
+            if cached is not None:
+                responses[i] = cached
+            else:
+                pending.append((i, generation))
+        batch_size = batch_size or self._search_batch_size
+        for start in range(0, len(pending), batch_size):
+            self._send(searches, pending[start:start + batch_size], responses)
+        return responses
+
+    def _send(self, searches: List[dict], pending: List[tuple], responses: List[dict]) -> None:
+        """
+        Send some searches of _search in a single GraphQL request and store their responses at their index
+        """
+        try:
+            if len(pending) == 1:
+                i, _ = pending[0]
+                names = [searches[i]['collection_name']]
+                res = searches[i]['query'].do()
+            else:
+                names = [f"search{i}" for i, _ in pending]
+                res = self._client.query.multi_get([searches[i]['query'].with_alias(name) for (i, _), name in zip(pending, names)]).do()
+        except Exception as e:
+            for i, _ in pending:
+                responses[i] = {'response': f'{e}'}
+            return
+
+        hits_by_name = (res.get('data') or {}).get('Get') or {}
+        for (i, generation), name in zip(pending, names):
+            search = searches[i]
+            hits = hits_by_name.get(name)
+            if hits is None or ('errors' in res and len(pending) == 1):
+                responses[i] = {'response': res.get('errors', f'No results for {name}')}
+                continue
+            top_results = []
+            # The query may have fetched top_k * overfetch candidates, only the best top_k are returned and cached
+            for hit in hits[:search['top_k']]:
+                score = hit['_additional'][search['score_field']]
+                document = self._hit2document(search['collection_name'], hit)
+                # Hybrid and bm25 scores are strings, keep near vector certainties in the same format for hybrid searches
+                document[search['result_field']] = str(score) if search['result_field'] == 'score' else score
+                top_results.append(document)
+            responses[i] = {'response': top_results}
+            self._cache_results(search['key'], generation, responses[i])
+
+    @invalidates_results
     def delete_collection(self, collection_name: str) -> dict:
         """
         Delete the entire collection
@@ -141,8 +496,13 @@ class VectorManager:
             self._client.schema.delete_class(collection_name)
         except Exception as e:
             return {'response':f"{e}"}
+        self._properties.pop(collection_name, None)
+        with self._uuids_lock:
+            self._uuids.pop(collection_name, None)
+            self._uuids_dropped += 1
         return {'response': "200"}
             
+    @invalidates_results
     def delete_document(self, collection_name: str, doc_id: str) -> dict:
         """
         Delete a document in a weaviate class
@@ -164,6 +524,7 @@ class VectorManager:
         if 'uuid' in uuid:
             try:
                 self._client.data_object.delete(uuid = uuid['uuid'], class_name=collection_name)
+                self._get_uuid_index(collection_name).pop(doc_id, None)
                 return {'response': "200"}
             except Exception as e:
                 return {'response': f"Unknown error with error message -> {e}"}
@@ -205,6 +566,7 @@ class VectorManager:
             return {'response': f"Unknown error with error message -> {e}"}
         return {'response': "200"}
 
+    @invalidates_results
     def create_document(self, collection_name: str, documents: Union[list, dict]) -> dict:
         """
         Create a document in a specified collection
@@ -243,12 +605,15 @@ class VectorManager:
                     return {'response': "Invalid vector type. Supported vector types: numpy.ndarray, torch.Tensor, list"}
                 embedding=doc['vector']
                 doc.pop('vector')
+            uuid = self._doc_uuid(collection_name, doc['doc_id'])
             try:
                 self._client.data_object.create(
                     doc,
                     collection_name,
+                    uuid = uuid,
                     vector = embedding
                 )
+                self._get_uuid_index(collection_name)[doc['doc_id']] = uuid
             except Exception as e:
                 if "vector lengths don't match" in str(e):
                     self.delete_document(collection_name, doc['doc_id'])
@@ -257,10 +622,14 @@ class VectorManager:
                     return {'response': f"{e}"}
         return {'response': "200"}
 
-    def batch_create_documents(self, collection_name: str, documents: Union[list, dict]) -> dict:
+    @invalidates_results
+    def batch_create_documents(self, collection_name: str, documents: Union[list, dict], batch_size: int = 40, dynamic: bool = False) -> dict:
         """
         Batch create documents in a specified collection to reduce the time taken to create a large set of documents.
         If any documents already exists, it will be skipped and the id will be returned in the response.
+        Documents Weaviate fails to store are returned in the response as well, and are not added to the uuid index.
+        Existence is only checked against the uuid index, a lookup per document would defeat batching: a document
+        another process has written since the index was built is replaced, as it gets the same uuid.
 
         INPUT: 
         ------------------------------------
@@ -271,23 +640,40 @@ class VectorManager:
                                 "doc_id": "72671",
                                 "vector": []
                             }
+        batch_size:         Number of documents sent per request. Default is 40
+        dynamic:            Let the client grow or shrink batch_size based on how fast Weaviate processes the batches. Default is False
 
         RETURNS: 
         ------------------------------------
-        dict:               Dictionary with the success code 200 or errors
-                            example: {'response': "200"}
+        dict:               Dictionary with the success code 200 or errors, the skipped and the failed doc_ids
+                            example: {'response': "200", 'existing_documents': ['72671'], 'failed_documents': []}
 
         """
         collection_name = collection_name.capitalize()
         if type(documents) == dict or len(documents) == 1:
             return self.create_document(collection_name, documents)
-        
+
+        index = self._get_uuid_index(collection_name)
+        added = {} # uuid -> doc_id of the objects sent, indexed once Weaviate reports them stored
+        failed_documents = []
+
+        def record_results(results):
+            for result in results or []:
+                doc_id = added.pop(result.get('id'), None)
+                if doc_id is None:
+                    continue
+                if 'result' in result and 'errors' in result['result']:
+                    print(f"Creating {doc_id} in {collection_name} failed: {result['result']['errors']}")
+                    failed_documents.append(doc_id)
+                else:
+                    index[doc_id] = result['id']
+
         self._client.batch.configure(
-            batch_size = 40,
-            dynamic = False,
+            batch_size = batch_size,
+            dynamic = dynamic,
             connection_error_retries = 3,
             timeout_retries = 3,
-            callback = weaviate.util.check_batch_result
+            callback = record_results
         )
 
         existing_documents = []
@@ -299,7 +685,7 @@ class VectorManager:
                 if not doc.get('doc_id'):
                     return {'response': f'Lack of doc_id as an attribute in property for doc {i}'}
                 # Check if the id exist
-                id_exists = self._exists(collection_name, doc['doc_id'])
+                id_exists = self._exists(collection_name, doc['doc_id'], check_server=False)
                 if id_exists:
                     existing_documents.append(doc['doc_id'])
                     continue
@@ -314,14 +700,18 @@ class VectorManager:
                 try:
                     # Batch auto-creates when full. 
                     # Last batch automatically added at end of `with` block
-                    batch.add_data_object(doc, collection_name, vector = embedding)
+                    uuid = self._doc_uuid(collection_name, doc['doc_id'])
+                    batch.add_data_object(doc, collection_name, uuid = uuid, vector = embedding)
+                    added[uuid] = doc['doc_id']
                 except Exception as e:
                     if "vector lengths don't match" in str(e):
                         print(f'response: Mismatch vector length, creation failed')
                     else:
                         return {'response': f"{e}"}
-                    
-        return {'response': "200", 'existing_documents': existing_documents}
+
+        # Objects without a result were never confirmed, e.g. their request failed after the retries
+        failed_documents += added.values()
+        return {'response': "200", 'existing_documents': existing_documents, 'failed_documents': failed_documents}
 
 
     def read_document(self, collection_name: str, doc_id: str) -> dict:
@@ -343,13 +733,12 @@ class VectorManager:
         collection_name = collection_name.capitalize()
         if not self._exists(collection_name, doc_id):
             return {'response': 'Attempt to read a non-existent document. No reading is done'}
-        # Create filter and search
         uuid = self._id2uuid(collection_name, doc_id)
         if 'uuid' in uuid:
             return {'response': self._client.data_object.get_by_id(uuid = uuid['uuid'], class_name = collection_name, with_vector = True)}
         return {'response': uuid['errors']}
     
-    def get_top_k(self, collection_name: str, target_embedding: Union[list, numpy.ndarray, torch.Tensor], top_k: int = 1) -> dict:
+    def get_top_k(self, collection_name: str, target_embedding: Union[list, numpy.ndarray, torch.Tensor], top_k: int = 1, with_vector: bool = True, offset: int = 0, overfetch: int = 1) -> dict:
         """
         Return the dictionary with the response key holding the list of near documents with certainty of at least 0.7
 
@@ -361,6 +750,11 @@ class VectorManager:
                             example: torch.Tensor([0.5766745, 0.9341823, 0.7021697, 0.54776406, 0.013553977])
         top_k:              integer value for the number of documents to return. Default is 1
                             example: 3
+        with_vector:        Whether to return the stored vector of each document. Default is True
+        offset:             Number of results to skip, for paging through results. Default is 0
+                            example: 10
+        overfetch:          Ask Weaviate for top_k * overfetch candidates and keep the best top_k, e.g. so a hybrid search fuses more candidates. Default is 1
+                            example: 3
 
         RETURNS: 
         ------------------------------------
@@ -382,40 +776,38 @@ class VectorManager:
         collection_name = collection_name.capitalize()
         if top_k < 1:
             return {'response': 'Invalid top_k'}
-        query_vector = {'vector': target_embedding, 'certainty': 0.7}
-        res = (
-            self._client.query
-               .get(collection_name, ["doc_id", "_additional {certainty, id}"])
-               .with_near_vector(query_vector)
-               .do()
-            )
-        if 'errors' in res:
-            return {'response': res['errors']}
+        if offset < 0:
+            return {'response': 'Invalid offset'}
+        if overfetch < 1:
+            return {'response': 'Invalid overfetch'}
         try:
-            limit = min(top_k, len(res['data']['Get'][collection_name]))
-            top_id = res['data']['Get'][collection_name][:limit]
-            top_results = [ self.read_document(collection_name, document['doc_id']) for document in top_id]
-            for document, res in zip(top_id, top_results):
-                res['certainty'] = document['_additional']['certainty']
-            return {'response': top_results}
+            search = self._near_vector_search(collection_name, target_embedding, top_k, with_vector, offset, overfetch)
         except Exception as e:
             return {'response': f'{e}'}
+        return self._search([search])[0]
         
-    def get_top_k_by_hybrid(self, collection_name: str, query_string: str, target_embedding: Union[list, numpy.ndarray, torch.Tensor], top_k: int = 1, alpha: int = 0.5) -> dict:
+    def get_top_k_by_hybrid(self, collection_name: str, query_string: str, target_embedding: Union[list, numpy.ndarray, torch.Tensor], top_k: int = 1, alpha: int = 0.5, with_vector: bool = True, offset: int = 0, overfetch: int = 1) -> dict:
         """
-        Return the dictionary with the response key holding the list of near documents
+        Return the dictionary with the response key holding the list of near documents.
+        With alpha 0 or 1 only one side of the hybrid search has weight, so a plain bm25 or near vector query is sent
+        instead and the unused query string or embedding may be None.
 
         INPUT: 
         ------------------------------------
         collection_name:    Name of collection
                             example shape:  'Faces'
-        query_string:       Query string for bm25 text similarity search
+        query_string:       Query string for bm25 text similarity search. Unused with alpha 1
                             example: "a dog standing next to an orange cat"
-        target_embedding:   Query embedding to find document with high cosine similarity
+        target_embedding:   Query embedding to find document with high cosine similarity. Unused with alpha 0
                             example: torch.Tensor([0.5766745, 0.9341823, 0.7021697, 0.54776406, 0.013553977])
         top_k:              integer value for the number of documents to return. Default is 1
                             example: 3
         alpha:              Weight of BM25 or vector search. 0 for pure keyword search, 1 for pure vector search. Default is 0.5
+        with_vector:        Whether to return the stored vector of each document. Default is True
+        offset:             Number of results to skip, for paging through results. Default is 0
+                            example: 10
+        overfetch:          Ask Weaviate for top_k * overfetch candidates and keep the best top_k, e.g. so a hybrid search fuses more candidates. Default is 1
+                            example: 3
 
         RETURNS: 
         ------------------------------------
@@ -437,33 +829,126 @@ class VectorManager:
         collection_name = collection_name.capitalize()
         if top_k < 1:
             return {'response': 'Invalid top_k'}
+        if offset < 0:
+            return {'response': 'Invalid offset'}
+        if overfetch < 1:
+            return {'response': 'Invalid overfetch'}
         
-        query_vector = target_embedding[0].tolist() # with_hybrid wants the vector as a list
-        res = (
-            self._client.query
-               .get(collection_name, ["doc_id"])
-               .with_hybrid(
-                    query_string,
-                    vector=query_vector, 
-                    alpha=alpha,
-                    properties = ["text"]
-                )
-               .with_additional(["score"])
-               .with_autocut(2)
-               .do()
-            )
-        if 'errors' in res:
-            return {'response': res['errors']}
         try:
-            limit = min(top_k, len(res['data']['Get'][collection_name]))
-            top_id = res['data']['Get'][collection_name][:limit]
-            top_results = [ self.read_document(collection_name, document['doc_id']) for document in top_id]
-            for document, res in zip(top_id, top_results):
-                res['score'] = document['_additional']['score']
-            return {'response': top_results}
+            search = self._hybrid_search(collection_name, query_string, target_embedding, top_k, alpha, with_vector, offset, overfetch)
         except Exception as e:
             return {'response': f'{e}'}
+        return self._search([search])[0]
+
+    def multi_get_top_k_by_hybrid(self, collection_names: List[str], query_string: str, target_embedding: Union[list, numpy.ndarray, torch.Tensor], top_k: int = 1, alpha: int = 0.5, with_vector: bool = True, offset: int = 0, overfetch: int = 1) -> List[dict]:
+        """
+        Run the same hybrid search as get_top_k_by_hybrid on several collections at once,
+        in a single GraphQL request instead of one request per collection
+
+        INPUT: 
+        ------------------------------------
+        collection_names:   Names of the collections to search
+                            example: ['ALIGN_M2E2_articles', 'ALIGN_M2E2_images']
+        query_string, target_embedding, top_k, alpha, with_vector, offset, overfetch:
+                            Same as get_top_k_by_hybrid
+
+        RETURNS: 
+        ------------------------------------
+        List:               One dictionary per collection, in the same order and format as get_top_k_by_hybrid
+                            example: [{response: [...]}, {response: [...]}]
+        """
+        if top_k < 1:
+            return [{'response': 'Invalid top_k'} for _ in collection_names]
+        if offset < 0:
+            return [{'response': 'Invalid offset'} for _ in collection_names]
+        if overfetch < 1:
+            return [{'response': 'Invalid overfetch'} for _ in collection_names]
+        try:
+            searches = [
+                self._hybrid_search(collection_name.capitalize(), query_string, target_embedding, top_k, alpha, with_vector, offset, overfetch)
+                for collection_name in collection_names
+            ]
+        except Exception as e:
+            return [{'response': f'{e}'} for _ in collection_names]
+        return self._search(searches)
+
+    def batch_get_top_k(self, collection_name: str, target_embeddings: List[Union[list, numpy.ndarray, torch.Tensor]], top_k: int = 1, with_vector: bool = True, offset: int = 0, overfetch: int = 1, batch_size: int = None) -> List[dict]:
+        """
+        Run get_top_k for many query embeddings, packing up to batch_size searches into each GraphQL request
+
+        INPUT: 
+        ------------------------------------
+        collection_name:    Name of collection
+                            example shape:  'Faces'
+        target_embeddings:  Query embeddings, one search each
+                            example: [torch.Tensor([0.5766745, 0.9341823, 0.7021697]), torch.Tensor([0.54776406, 0.013553977, 0.9341823])]
+        top_k, with_vector, offset, overfetch:
+                            Same as get_top_k
+        batch_size:         Maximum number of searches per request. Default is SEARCH_BATCH_SIZE
+                            example: 16
+
+        RETURNS: 
+        ------------------------------------
+        List:               One dictionary per query embedding, in the same order and format as get_top_k
+                            example: [{response: [...]}, {response: [...]}]
+        """
+        collection_name = collection_name.capitalize()
+        if top_k < 1:
+            return [{'response': 'Invalid top_k'} for _ in target_embeddings]
+        if offset < 0:
+            return [{'response': 'Invalid offset'} for _ in target_embeddings]
+        if overfetch < 1:
+            return [{'response': 'Invalid overfetch'} for _ in target_embeddings]
+        try:
+            searches = [
+                self._near_vector_search(collection_name, target_embedding, top_k, with_vector, offset, overfetch)
+                for target_embedding in target_embeddings
+            ]
+        except Exception as e:
+            return [{'response': f'{e}'} for _ in target_embeddings]
+        return self._search(searches, batch_size)
+
+    def batch_get_top_k_by_hybrid(self, collection_name: str, query_strings: List[str], target_embeddings: List[Union[list, numpy.ndarray, torch.Tensor]], top_k: int = 1, alpha: int = 0.5, with_vector: bool = True, offset: int = 0, overfetch: int = 1, batch_size: int = None) -> List[dict]:
+        """
+        Run get_top_k_by_hybrid for many queries, packing up to batch_size searches into each GraphQL request
+
+        INPUT: 
+        ------------------------------------
+        collection_name:    Name of collection
+                            example shape:  'Faces'
+        query_strings:      Query strings for bm25 text similarity search, one per query. Unused with alpha 1
+                            example: ["a dog standing next to an orange cat", "a protest in front of a building"]
+        target_embeddings:  Query embeddings, one per query. Unused with alpha 0
+                            example: [torch.Tensor([[0.5766745, 0.9341823, 0.7021697]]), torch.Tensor([[0.54776406, 0.013553977, 0.9341823]])]
+        top_k, alpha, with_vector, offset, overfetch:
+                            Same as get_top_k_by_hybrid
+        batch_size:         Maximum number of searches per request. Default is SEARCH_BATCH_SIZE
+                            example: 16
+
+        RETURNS: 
+        ------------------------------------
+        List:               One dictionary per query, in the same order and format as get_top_k_by_hybrid
+                            example: [{response: [...]}, {response: [...]}]
+        """
+        collection_name = collection_name.capitalize()
+        if len(query_strings) != len(target_embeddings):
+            raise ValueError("query_strings and target_embeddings must have the same length")
+        if top_k < 1:
+            return [{'response': 'Invalid top_k'} for _ in query_strings]
+        if offset < 0:
+            return [{'response': 'Invalid offset'} for _ in query_strings]
+        if overfetch < 1:
+            return [{'response': 'Invalid overfetch'} for _ in query_strings]
+        try:
+            searches = [
+                self._hybrid_search(collection_name, query_string, target_embedding, top_k, alpha, with_vector, offset, overfetch)
+                for query_string, target_embedding in zip(query_strings, target_embeddings)
+            ]
+        except Exception as e:
+            return [{'response': f'{e}'} for _ in query_strings]
+        return self._search(searches, batch_size)
 
+    @invalidates_results
     def update_document(self, collection_name: str, doc_id:str, document: dict) -> dict:
         """
         Update a document in a specified collection
@@ -0,0 +1,122 @@
+"""
+Compare the dynamic int8 quantized models (QUANTIZE_MODELS) against fp32 on CPU.
+
+For each mode, single queries are run one at a time, as the API serves them, and the script reports the
+mean latency per query and how closely the quantized outputs agree with fp32:
+
+    align       ALIGN text embeddings of the articles, cosine similarity to the fp32 embedding
+    ram, t2t    RAM tags + Tag2Text caption of the images, tag overlap and caption agreement with fp32
+
+Models are loaded one mode at a time, so the fp32 and int8 weights are never in memory together.
+
+Usage (from the fastapi directory, inside the fastapi container):
+
+    $ python benchmark_quantization.py --data /data/m2e2 --limit 50
+    $ python benchmark_quantization.py --models ram t2t --threads 4
+"""
+from models import load_model, IMAGE_SIZE
+from models.ram import inference_caption, get_transform
+from PIL import Image
+
+import argparse
+import gc
+import os
+import time
+import numpy as np
+import torch
+
+
+def read_inputs(args):
+    article_dir = os.path.join(args.data, 'article')
+    image_dir = os.path.join(args.data, 'image', 'image')
+    texts = []
+    for name in sorted(os.listdir(article_dir))[:args.limit]:
+        with open(os.path.join(article_dir, name), 'r') as f:
+            texts.append(f.read())
+    images = [Image.open(os.path.join(image_dir, name)).convert('RGB') for name in sorted(os.listdir(image_dir))[:args.limit]]
+    return texts, images
+
+
+def timed(fn, inputs: list):
+    """
+    Run fn on each input after one warm-up call, return the outputs and the mean latency in ms.
+    """
+    fn(inputs[0])
+    outputs = []
+    started = time.perf_counter()
+    for item in inputs:
+        outputs.append(fn(item))
+    return outputs, (time.perf_counter() - started) / len(inputs) * 1000
+
+
+def run_align(texts: list, quantized: bool, max_length: int):
+    align_model = load_model('align', quantized=quantized)
+    outputs, latency = timed(lambda text: align_model.get_text_embeddings([text], max_length=max_length)[0], texts)
+    del align_model
+    gc.collect()
+    return outputs, latency
+
+
+def run_caption(images: list, ram_quantized: bool, t2t_quantized: bool):
+    ram_model = load_model('ram', quantized=ram_quantized)
+    t2t_model = load_model('t2t', quantized=t2t_quantized)
+    transform = get_transform(image_size=IMAGE_SIZE)
+
+    def caption(image):
+        tags, captions = inference_caption(transform(image).unsqueeze(0), ram_model, t2t_model)
+        return tags[0], captions[0]
+
+    outputs, latency = timed(caption, images)
+    del ram_model, t2t_model
+    gc.collect()
+    return outputs, latency
+
+
+def jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+def report_align(texts: list, args) -> None:
+    fp32, fp32_latency = run_align(texts, False, args.max_text_tokens)
+    int8, int8_latency = run_align(texts, True, args.max_text_tokens)
+    cosine = [np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)) for a, b in zip(fp32, int8)]
+    print(f"align text ({len(texts)} queries)")
+    print(f"  latency      fp32 {fp32_latency:.1f} ms | int8 {int8_latency:.1f} ms | speedup {fp32_latency / int8_latency:.2f}x")
+    print(f"  cosine       mean {np.mean(cosine):.4f} | min {np.min(cosine):.4f}")
+
+
+def report_caption(images: list, args) -> None:
+    ram_quantized = 'ram' in args.models
+    t2t_quantized = 't2t' in args.models
+    fp32, fp32_latency = run_caption(images, False, False)
+    int8, int8_latency = run_caption(images, ram_quantized, t2t_quantized)
+
+    tag_overlap = [jaccard(set(a[0].split(' | ')), set(b[0].split(' | '))) for a, b in zip(fp32, int8)]
+    same_tags = np.mean([a[0] == b[0] for a, b in zip(fp32, int8)])
+    word_overlap = [jaccard(set(a[1].split()), set(b[1].split())) for a, b in zip(fp32, int8)]
+    same_caption = np.mean([a[1] == b[1] for a, b in zip(fp32, int8)])
+    print(f"caption ({len(images)} images, int8: {' + '.join(name for name in ['ram', 't2t'] if name in args.models)})")
+    print(f"  latency      fp32 {fp32_latency:.1f} ms | int8 {int8_latency:.1f} ms | speedup {fp32_latency / int8_latency:.2f}x")
+    print(f"  tags         identical {same_tags:.1%} | mean jaccard {np.mean(tag_overlap):.3f}")
+    print(f"  caption      identical {same_caption:.1%} | mean word jaccard {np.mean(word_overlap):.3f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark dynamic int8 quantization against fp32 on CPU.")
+    parser.add_argument('--data', default='/data/m2e2', help="M2E2 dataset directory")
+    parser.add_argument('--models', nargs='+', default=['align', 'ram', 't2t'], choices=['align', 'ram', 't2t'], help="Models to quantize")
+    parser.add_argument('--limit', type=int, default=50, help="Number of articles and images to run")
+    parser.add_argument('--max-text-tokens', type=int, default=64, help="Truncate articles to this many tokens")
+    parser.add_argument('--threads', type=int, default=None, help="Torch threads, defaults to torch's own choice")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    texts, images = read_inputs(args)
+    if 'align' in args.models:
+        report_align(texts, args)
+    if 'ram' in args.models or 't2t' in args.models:
+        report_caption(images, args)
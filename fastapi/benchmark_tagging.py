@@ -0,0 +1,69 @@
+"""
+Compare RAM's approximate tagging mode (RAM_TAG_CANDIDATES) against the full mode.
+
+In the approximate mode, labels are shortlisted by the similarity of their embedding to the image CLS
+embedding and only the shortlisted ones go through the tagging head. For each shortlist size, the script
+reports the mean latency of RAM tagging per image and how many of the full mode's tags are still found:
+
+    recall      share of the full mode's tags also returned by the approximate mode
+    exact       share of images getting exactly the full mode's tags
+
+The approximate tags are always a subset of the full mode's, shortlisted labels get the same probabilities.
+
+Usage (from the fastapi directory, inside the fastapi container):
+
+    $ python benchmark_tagging.py --data /data/m2e2 --limit 50 --candidates 100 250 500 1000
+"""
+from models import load_model, IMAGE_SIZE
+from models.ram import get_transform
+from PIL import Image
+
+import argparse
+import os
+import time
+import numpy as np
+import torch
+
+
+def run(ram_model, images: list, candidates: int):
+    """
+    Tag each image on its own after one warm-up call, return the tag sets and the mean latency in ms.
+    """
+    ram_model.generate_tag(images[0], candidates=candidates)
+    tags = []
+    started = time.perf_counter()
+    for image in images:
+        tags.append(set(ram_model.generate_tag(image, candidates=candidates)[0].split(' | ')) - {''})
+    return tags, (time.perf_counter() - started) / len(images) * 1000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark RAM's approximate tagging mode against the full mode.")
+    parser.add_argument('--data', default='/data/m2e2', help="M2E2 dataset directory")
+    parser.add_argument('--limit', type=int, default=50, help="Number of images to tag")
+    parser.add_argument('--candidates', type=int, nargs='+', default=[100, 250, 500, 1000], help="Shortlist sizes to compare")
+    parser.add_argument('--threads', type=int, default=None, help="Torch threads, defaults to torch's own choice")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    image_dir = os.path.join(args.data, 'image', 'image')
+    transform = get_transform(image_size=IMAGE_SIZE)
+    ram_model = load_model('ram')
+    images = [
+        transform(Image.open(os.path.join(image_dir, name)).convert('RGB')).unsqueeze(0).to(ram_model.class_threshold.device)
+        for name in sorted(os.listdir(image_dir))[:args.limit]
+    ]
+
+    with torch.no_grad():
+        full, full_latency = run(ram_model, images, 0)
+        print(f"full ({ram_model.num_class} labels): {full_latency:.1f} ms/image, {np.mean([len(tags) for tags in full]):.1f} tags/image")
+        for candidates in args.candidates:
+            approx, latency = run(ram_model, images, candidates)
+            recall = sum(len(a & f) for a, f in zip(approx, full)) / max(1, sum(len(f) for f in full))
+            exact = np.mean([a == f for a, f in zip(approx, full)])
+            print(f"top {candidates}: {latency:.1f} ms/image ({full_latency / latency:.2f}x) | recall {recall:.3f} | exact {exact:.1%}")
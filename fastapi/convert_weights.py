@@ -0,0 +1,16 @@
+"""
+Convert the RAM and Tag2Text checkpoints under models/weights into memory-mappable safetensors files.
+
+This only needs to run once, and again whenever the .pth checkpoints change. The app then loads the
+converted files instead: they are mapped zero-copy rather than unpickled and post-processed on every
+start, and all workers on a node share one physical copy of the weights through the page cache.
+
+Usage (from the fastapi directory, inside the fastapi container):
+
+    $ python convert_weights.py
+"""
+from models import convert_checkpoints
+
+
+if __name__ == '__main__':
+    convert_checkpoints()
@@ -0,0 +1,39 @@
+"""
+Gunicorn settings for the preforked serving mode (FASTAPI_WORKERS > 0, see start.sh).
+
+The app and its models are loaded once in the master process, then FASTAPI_WORKERS uvicorn workers are
+forked from it. On CPU the model weights are shared copy-on-write between the workers instead of being
+loaded N times. Each worker runs torch with TORCH_THREADS intra-op threads, by default the cores divided
+evenly between the workers so they do not oversubscribe the machine.
+
+Usage (from the fastapi directory):
+
+    $ FASTAPI_WORKERS=4 gunicorn main:app -c gunicorn_conf.py
+"""
+import gc
+import os
+
+workers = max(1, int(os.environ.get('FASTAPI_WORKERS', 1)))
+worker_class = 'uvicorn.workers.UvicornWorker'
+bind = f"0.0.0.0:{os.environ.get('FASTAPI_C_PORT', 8000)}"
+preload_app = True
+# Loading models on a first request can take a while, don't let the master kill the worker meanwhile
+timeout = int(os.environ.get('WORKER_TIMEOUT', 300))
+
+
+def when_ready(server):
+    from models import device, preload
+
+    # Workers cannot use a CUDA context created before the fork, on GPU each worker loads its own models
+    if device == 'cpu':
+        preload()
+    # Keep the garbage collector from writing to (and so copying) the pages of every object loaded so far
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import torch
+
+    threads = int(os.environ.get('TORCH_THREADS') or 0) or max(1, (os.cpu_count() or 1) // workers)
+    torch.set_num_threads(threads)
+    server.log.info(f"Worker {worker.pid} uses {threads} torch threads")
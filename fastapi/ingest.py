@@ -0,0 +1,343 @@
+"""
+Rebuild the M2E2 collections from the articles and images under data/m2e2.
+
+Documents stream through a pipeline of threads connected by bounded queues:
+
+    read -> embed (ALIGN, optional MLP) -> caption (RAM + T2T, images only) -> write (Weaviate batches)
+
+Doc ids that have been stored in every target collection are appended to a checkpoint file, so an
+interrupted run picks up where it stopped. Documents Weaviate rejects are not checkpointed and are retried
+by the next run. Throughput of each stage is reported every few seconds.
+
+Documents already in a collection are skipped, not replaced. To re-index after a model change, pass
+--recreate: the target collections are deleted and the checkpoint is cleared before starting.
+
+Usage (from the fastapi directory, inside the fastapi container):
+
+    $ python ingest.py --data /data/m2e2
+    $ python ingest.py --data /data/m2e2 --collections ALIGN_M2E2_articles ALIGN_M2E2_images --no-caption
+    $ python ingest.py --data /data/m2e2 --caption-tier beam
+    $ python ingest.py --data /data/m2e2 --recreate
+"""
+from WeaviateManager import VectorManager
+from models import get_model, generate_captions, device, CAPTION_TIERS
+from PIL import Image
+
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+import torch
+
+COLLECTIONS = {
+    'ALIGN_M2E2': {"doc_id": "str", "content_path": "str", "text": "str"},
+    'ALIGN_MLP_M2E2': {"doc_id": "str", "content_path": "str", "text": "str"},
+    'ALIGN_M2E2_articles': {"doc_id": "str", "article": "str", "text": "str"},
+    'ALIGN_M2E2_images': {"doc_id": "str", "image": "str", "text": "str"},
+}
+
+DONE = None # End of stream marker passed down the pipeline
+
+
+class Stage:
+    """
+    Bookkeeping for one pipeline stage: documents processed and time spent working on them.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.skipped = 0 # documents passed on without being processed, e.g. already in a collection
+        self.busy = 0.0
+
+    def add(self, count: int, started: float) -> None:
+        self.count += count
+        self.busy += time.monotonic() - started
+
+    def rate(self) -> float:
+        return self.count / self.busy if self.busy > 0 else 0.0
+
+    def __str__(self) -> str:
+        skipped = f", {self.skipped} skipped" if self.skipped else ""
+        return f"{self.name} {self.count} docs ({self.rate():.1f} docs/s{skipped})"
+
+
+class Pipeline:
+    def __init__(self, args):
+        self.args = args
+        self.stop = threading.Event()
+        self.errors = []
+        self.stages = {name: Stage(name) for name in ['read', 'embed', 'caption', 'write']}
+        # Documents are read one at a time and batched by the embed stage, later queues hold whole batches
+        self.queues = [queue.Queue(maxsize=args.queue_size * args.batch_size)] + [queue.Queue(maxsize=args.queue_size) for _ in range(2)]
+
+        self.vector_manager = VectorManager()
+        self.done = self._load_checkpoint()
+        self.captions = self._load_dataset_captions()
+
+    def _load_checkpoint(self) -> set:
+        if not os.path.isfile(self.args.checkpoint):
+            return set()
+        with open(self.args.checkpoint, 'r') as f:
+            return set(line.strip() for line in f if line.strip())
+
+    def _load_dataset_captions(self) -> dict:
+        path = os.path.join(self.args.data, 'image', 'image_url_caption.json')
+        if not os.path.isfile(path):
+            return {}
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def _dataset_caption(self, image_name: str) -> str:
+        image_key = image_name[:-6] # This is specific to the M2E2 dataset
+        image_index = image_name[-5]
+        try:
+            return self.captions[image_key][image_index]['caption']
+        except KeyError:
+            return ""
+
+    def _put(self, q: queue.Queue, item) -> None:
+        # Bounded queues apply backpressure; keep checking for a failed stage while waiting
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, q: queue.Queue):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return DONE
+
+    def _get_batch(self, q: queue.Queue) -> list:
+        """
+        Block for one item, then take whatever else is already queued up to the batch size.
+        Returns DONE once the end of stream has been reached and no items are left.
+        """
+        item = self._get(q)
+        if item is DONE:
+            return DONE
+        batch = [item]
+        while len(batch) < self.args.batch_size:
+            try:
+                item = q.get_nowait()
+            except queue.Empty:
+                break
+            if item is DONE:
+                # Hand the marker back so the next call ends the stream
+                q.put(DONE)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self, target) -> threading.Thread:
+        def guarded():
+            try:
+                target()
+            except Exception as e:
+                self.errors.append(e)
+                self.stop.set()
+        thread = threading.Thread(target=guarded, name=target.__name__, daemon=True)
+        thread.start()
+        return thread
+
+    def read(self) -> None:
+        stage = self.stages['read']
+        article_dir = os.path.join(self.args.data, 'article')
+        image_dir = os.path.join(self.args.data, 'image', 'image')
+        sources = []
+        if os.path.isdir(article_dir):
+            sources += [('article', article_dir, name) for name in sorted(os.listdir(article_dir))]
+        if os.path.isdir(image_dir):
+            sources += [('image', image_dir, name) for name in sorted(os.listdir(image_dir))]
+
+        for kind, directory, name in sources:
+            if self.stop.is_set():
+                return
+            doc_id = os.path.splitext(name)[0]
+            if doc_id in self.done:
+                continue
+            started = time.monotonic()
+            document = {'kind': kind, 'doc_id': doc_id, 'path': name}
+            try:
+                if kind == 'article':
+                    with open(os.path.join(directory, name), 'r') as f:
+                        document['text'] = f.read()
+                else:
+                    document['image'] = Image.open(os.path.join(directory, name)).convert('RGB')
+                    document['text'] = self._dataset_caption(name)
+            except OSError as e:
+                print(f"Skipping {name}: {e}")
+                continue
+            stage.add(1, started)
+            self._put(self.queues[0], document)
+        self._put(self.queues[0], DONE)
+
+    def embed(self) -> None:
+        stage = self.stages['embed']
+        with torch.inference_mode():
+            while True:
+                batch = self._get_batch(self.queues[0])
+                if batch is DONE:
+                    break
+                started = time.monotonic()
+                articles = [doc for doc in batch if doc['kind'] == 'article']
+                images = [doc for doc in batch if doc['kind'] == 'image']
+                if articles:
+                    embeddings = get_model('align').get_text_embeddings([doc['text'] for doc in articles], max_length=self.args.max_text_tokens)
+                    mlp_embeddings = None
+                    if self.args.mlp:
+                        mlp_embeddings = get_model('mlp')(torch.tensor(embeddings).to(device)).cpu().numpy()
+                    for i, doc in enumerate(articles):
+                        doc['vector'] = embeddings[i]
+                        # The MLP maps text embeddings next to the image embeddings, images are stored as is
+                        doc['mlp_vector'] = mlp_embeddings[i] if mlp_embeddings is not None else None
+                if images:
+                    embeddings = get_model('align').get_image_embeddings([doc['image'] for doc in images])
+                    for i, doc in enumerate(images):
+                        doc['vector'] = embeddings[i]
+                        doc['mlp_vector'] = embeddings[i]
+                stage.add(len(batch), started)
+                self._put(self.queues[1], batch)
+        self._put(self.queues[1], DONE)
+
+    def caption(self) -> None:
+        stage = self.stages['caption']
+        while True:
+            batch = self._get(self.queues[1])
+            if batch is DONE:
+                break
+            images = [doc for doc in batch if doc['kind'] == 'image']
+            if self.args.caption and images:
+                started = time.monotonic()
+                for doc, (caption, _) in zip(images, generate_captions([doc['image'] for doc in images], tier=self.args.caption_tier)):
+                    doc['text'] = caption
+                stage.add(len(images), started)
+            for doc in images:
+                # Decoded pixels are no longer needed, don't hold them in the write queue
+                del doc['image']
+            self._put(self.queues[2], batch)
+        self._put(self.queues[2], DONE)
+
+    def _collection_documents(self, collection_name: str, batch: list) -> list:
+        documents = []
+        for doc in batch:
+            document = {'doc_id': doc['doc_id'], 'text': doc['text']}
+            if collection_name == 'ALIGN_M2E2_articles':
+                if doc['kind'] != 'article':
+                    continue
+                document['article'] = doc['path']
+            elif collection_name == 'ALIGN_M2E2_images':
+                if doc['kind'] != 'image':
+                    continue
+                document['image'] = doc['path']
+            else:
+                document['content_path'] = doc['path']
+            vector = doc['mlp_vector'] if collection_name == 'ALIGN_MLP_M2E2' else doc['vector']
+            document['vector'] = vector.tolist()
+            documents.append(document)
+        return documents
+
+    def write(self) -> None:
+        stage = self.stages['write']
+        with open(self.args.checkpoint, 'a') as checkpoint:
+            while True:
+                batch = self._get(self.queues[2])
+                if batch is DONE:
+                    break
+                started = time.monotonic()
+                failed = set()
+                existing = set()
+                targeted = set()
+                for collection_name in self.args.collections:
+                    documents = self._collection_documents(collection_name, batch)
+                    if len(documents) == 0:
+                        continue
+                    targeted.update(doc['doc_id'] for doc in documents)
+                    res = self.vector_manager.batch_create_documents(collection_name, documents, batch_size=self.args.batch_size, dynamic=True)
+                    # A single leftover document goes through create_document, which refuses existing ids
+                    if 'already exists' in res['response']:
+                        res = {'response': "200", 'existing_documents': [doc['doc_id'] for doc in documents]}
+                    if res['response'] != "200":
+                        # Same as documents rejected inside a batch: not checkpointed, the next run retries them
+                        print(f"Warning: writing to {collection_name} failed: {res['response']}")
+                        res = {'response': "200", 'failed_documents': [doc['doc_id'] for doc in documents]}
+                    failed.update(res.get('failed_documents', []))
+                    if res.get('existing_documents'):
+                        existing.update(res['existing_documents'])
+                        print(f"Warning: {len(res['existing_documents'])} documents already in {collection_name} were skipped, "
+                              f"not replaced (e.g. written by an interrupted run). Use --recreate to re-index them.")
+                if failed:
+                    print(f"Warning: {len(failed)} documents were rejected by Weaviate, they are not checkpointed and the next run retries them")
+                # Only checkpoint once a document is in every target collection of its kind, and in at least one
+                stored = [doc for doc in batch if doc['doc_id'] in targeted and doc['doc_id'] not in failed]
+                checkpoint.writelines(f"{doc['doc_id']}\n" for doc in stored)
+                checkpoint.flush()
+                written = [doc for doc in stored if doc['doc_id'] not in existing]
+                stage.skipped += len(stored) - len(written)
+                stage.add(len(written), started)
+
+    def report(self, threads: list) -> None:
+        started = time.monotonic()
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(self.args.report_every)
+            written = self.stages['write'].count
+            elapsed = time.monotonic() - started
+            print(" | ".join(str(stage) for stage in self.stages.values()) + f" | overall {written / elapsed:.1f} docs/s", flush=True)
+
+    def recreate(self) -> None:
+        """
+        Delete the target collections and the checkpoint, so every document is written again.
+        """
+        for collection_name in self.args.collections:
+            res = self.vector_manager.delete_collection(collection_name)
+            if res['response'] != "200":
+                print(f"{collection_name}: {res['response']}")
+        if os.path.isfile(self.args.checkpoint):
+            os.remove(self.args.checkpoint)
+        self.done = set()
+
+    def run(self) -> None:
+        if self.args.recreate:
+            self.recreate()
+        for collection_name in self.args.collections:
+            res = self.vector_manager.create_collection(collection_name, COLLECTIONS[collection_name])
+            if res['response'] != "200":
+                print(f"{collection_name}: {res['response']}")
+        if len(self.done) > 0:
+            print(f"Resuming, {len(self.done)} documents already ingested")
+
+        threads = [self._run(stage) for stage in [self.read, self.embed, self.caption, self.write]]
+        self.report(threads)
+        for thread in threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+        print("Done: " + " | ".join(str(stage) for stage in self.stages.values()))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Ingest the M2E2 articles and images into Weaviate.")
+    parser.add_argument('--data', default='/data/m2e2', help="M2E2 dataset directory")
+    parser.add_argument('--collections', nargs='+', default=list(COLLECTIONS), choices=list(COLLECTIONS), help="Collections to (re)build")
+    parser.add_argument('--checkpoint', default='ingest_checkpoint.txt', help="File listing the doc ids already ingested")
+    parser.add_argument('--batch-size', type=int, default=32, help="Documents per model forward and per Weaviate batch")
+    parser.add_argument('--queue-size', type=int, default=8, help="Maximum number of batches waiting between two stages")
+    parser.add_argument('--max-text-tokens', type=int, default=64, help="Truncate articles to this many tokens before embedding")
+    parser.add_argument('--recreate', action='store_true', help="Delete the target collections and the checkpoint first, to re-index every document")
+    parser.add_argument('--no-caption', dest='caption', action='store_false', help="Use the dataset captions instead of generating RAM/T2T captions")
+    parser.add_argument('--caption-tier', default='full', choices=list(CAPTION_TIERS), help="Caption decoding settings, re-indexing can afford the full one")
+    parser.add_argument('--report-every', type=float, default=10, help="Seconds between throughput reports")
+    args = parser.parse_args()
+    args.mlp = 'ALIGN_MLP_M2E2' in args.collections
+    return args
+
+
+if __name__ == '__main__':
+    Pipeline(parse_args()).run()
@@ -1,10 +1,16 @@
 from WeaviateManager import VectorManager
-from models import generate_image_query, generate_text_query
-from typing import Optional
-from PIL import Image
-from io import BytesIO
+from models import generate_image_query, generate_text_query, generate_image_queries, generate_text_queries, query_cache, SERVED_MODELS, CAPTION_TIERS
+from typing import Optional, List
+from concurrent.futures import ThreadPoolExecutor
 
-from fastapi import FastAPI, UploadFile
+import asyncio
+import functools
+import json
+import os
+import threading
+
+from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi.responses import StreamingResponse
 
 COLLECTIONS = {
     0: 'ALIGN_M2E2',
@@ -22,15 +28,87 @@ app = FastAPI(
 
 VecMgr = VectorManager()
 
+
+class BoundedExecutor:
+    """
+    Thread pool with a cap on queued work. Once max_workers calls are running and max_queued more are
+    waiting, new calls are rejected with a 503 instead of piling up behind a slow worker.
+    """
+
+    def __init__(self, max_workers: int, max_queued: int, name: str):
+        self.name = name
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_workers + max_queued)
+
+    async def run(self, fn, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            raise HTTPException(status_code=503, detail=f"Server busy ({self.name} queue is full), retry later", headers={"Retry-After": "1"})
+        try:
+            future = self._executor.submit(functools.partial(fn, *args, **kwargs))
+        except BaseException:
+            self._slots.release()
+            raise
+        # Released when the call is done, not when the request stops waiting for it: a cancelled request
+        # (e.g. a client disconnect) leaves a running call holding its slot until it finishes
+        future.add_done_callback(lambda _: self._slots.release())
+        return await asyncio.wrap_future(future)
+
+
+# Model forwards and Weaviate calls block, so they run on their own pools to keep the event loop free.
+# Inference threads mostly wait on the models' batch scheduler, so the pool size also caps the batch size.
+inference_executor = BoundedExecutor(
+    max_workers=int(os.environ.get('INFERENCE_WORKERS', 16)),
+    max_queued=int(os.environ.get('INFERENCE_QUEUE_SIZE', 64)),
+    name="inference",
+)
+db_executor = BoundedExecutor(
+    max_workers=int(os.environ.get('DB_WORKERS', 8)),
+    max_queued=int(os.environ.get('DB_QUEUE_SIZE', 64)),
+    name="db",
+)
+
+# Larger image uploads are rejected before being decoded
+MAX_UPLOAD_BYTES = int(float(os.environ.get('MAX_UPLOAD_MB', 20)) * 1024 * 1024)
+# Queries of a batch request are embedded and searched this many at a time
+BATCH_QUERY_CHUNK_SIZE = int(os.environ.get('BATCH_QUERY_CHUNK_SIZE', 64))
+
+
+def plan_stages(model: int, alpha: float) -> tuple:
+    """
+    Return which model stages a query needs, as (with_embedding, with_caption).
+    With alpha 0 hybrid search is pure BM25 and with alpha 1 pure vector search,
+    so the model stage feeding the side without weight is skipped and a plain BM25 or near vector query is sent.
+    """
+    hybrid = model == 2 or model == 3
+    return not hybrid or alpha > 0, hybrid and alpha < 1
+
+
+def check_query_settings(model: int, caption_tier: Optional[str]) -> None:
+    """
+    Reject a query whose model is not served by this worker (404) or whose caption tier is unknown (400).
+    """
+    if model not in SERVED_MODELS:
+        raise HTTPException(status_code=404, detail=f"Model {model} is not served by this worker")
+    if caption_tier is not None and caption_tier not in CAPTION_TIERS:
+        raise HTTPException(status_code=400, detail=f"Invalid caption tier {caption_tier}, choose one of {list(CAPTION_TIERS)}")
+
+
 @app.get("/")
 def read_root():
     return {"Hello": "World"}
 
+@app.get("/cache_stats")
+def cache_stats():
+    """
+    Hit/miss counters of the query embedding and caption cache.
+    """
+    return query_cache.stats()
+
 """
 Querying
 """
 @app.post("/query_top_k_documents")
-async def query_top_k_documents(text_query: Optional[str] = None, top_k: int = 10, image_file: Optional[UploadFile] = None, model: int = 0, alpha: float = 0.5):
+async def query_top_k_documents(text_query: Optional[str] = None, top_k: int = 10, image_file: Optional[UploadFile] = None, model: int = 0, alpha: float = 0.5, offset: int = 0, caption_tier: Optional[str] = None):
     """
     Queries both article and image collections in the vector database for the top k documents of each collection most similar to the query.
     
@@ -53,6 +131,14 @@ async def query_top_k_documents(text_query: Optional[str] = None, top_k: int = 1
                     Weight of BM25 or vector search. 
                     0 for pure keyword search, 1 for pure vector search.
 
+    offset (int):   
+                    Number of results per modality to skip, for paging through results.
+
+    caption_tier (Optional[str]):
+                    Caption decoding settings for image queries on models 2 and 3, from fastest to best:
+                    'fast' (greedy, short captions), 'beam' (3 beams) or 'full' (3 beams, longest captions).
+                    Defaults to the server's CAPTION_TIER.
+
     RETURNS: 
     ------------------------------------
         dict:       Dictionary of results or error. If hybrid search is involved, query text is also returned
@@ -76,8 +162,12 @@ async def query_top_k_documents(text_query: Optional[str] = None, top_k: int = 1
                         "query_text": query_text
                     }
     """
+    check_query_settings(model, caption_tier)
+
+    with_embedding, with_caption = plan_stages(model, alpha)
+
     if text_query is not None:
-        query_embedding, query_text = generate_text_query(text_query, model)
+        query_embedding, query_text = await inference_executor.run(generate_text_query, text_query, model, with_embedding=with_embedding)
         tags = None
 
     else:
@@ -85,27 +175,30 @@ async def query_top_k_documents(text_query: Optional[str] = None, top_k: int = 1
             raise Exception("No image provided")
         
         try:
-            image_content = await image_file.read()
-            image_content = Image.open(BytesIO(image_content))
+            image_content = await image_file.read(MAX_UPLOAD_BYTES + 1)
+            if len(image_content) > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail=f"Image larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+            # Decoded by the models package, and only if the image is not cached yet
+            query_embedding, query_text, tags = await inference_executor.run(generate_image_query, image_content, model, caption_tier,
+                                                                         with_caption=with_caption, with_embedding=with_embedding)
 
-        except Exception as e:
+        except OSError as e:
             return {f"error: {e}"}
-        query_embedding, query_text, tags = generate_image_query(image_content, model)
     
     COLLECTION_NAME = COLLECTIONS[model]
 
     if model == 0:
-        res = VecMgr.get_top_k(COLLECTION_NAME, query_embedding, top_k)
+        res = await db_executor.run(VecMgr.get_top_k, COLLECTION_NAME, query_embedding, top_k, offset=offset)
         
         return {"results": res}
 
     elif model == 1:
-        res = VecMgr.get_top_k(COLLECTION_NAME, query_embedding, top_k)
+        res = await db_executor.run(VecMgr.get_top_k, COLLECTION_NAME, query_embedding, top_k, offset=offset)
 
         return {"results": res}
     
     elif model == 2:
-        res = VecMgr.get_top_k_by_hybrid(COLLECTION_NAME, query_text, query_embedding, top_k, alpha)
+        res = await db_executor.run(VecMgr.get_top_k_by_hybrid, COLLECTION_NAME, query_text, query_embedding, top_k, alpha, offset=offset)
 
         return {"results": res, "query_text": query_text, "image_tags": tags}
     
@@ -113,10 +206,159 @@ async def query_top_k_documents(text_query: Optional[str] = None, top_k: int = 1
         TEXT_COLLECTION_NAME = COLLECTION_NAME['text']
         IMAGE_COLLECTION_NAME = COLLECTION_NAME['image']
 
-        text_res = VecMgr.get_top_k_by_hybrid(TEXT_COLLECTION_NAME, query_text, query_embedding, top_k, alpha)
-        image_res = VecMgr.get_top_k_by_hybrid(IMAGE_COLLECTION_NAME, query_text, query_embedding, top_k, alpha)
+        # Both collections are searched in a single request
+        text_res, image_res = await db_executor.run(VecMgr.multi_get_top_k_by_hybrid, [TEXT_COLLECTION_NAME, IMAGE_COLLECTION_NAME], query_text, query_embedding, top_k, alpha, offset=offset)
 
         return {"text_results": text_res, "image_results": image_res, "query_text": query_text, "image_tags": tags}
 
     else:
         raise Exception("Invalid model choice")
+
+
+def batch_search(model: int, queries: list, top_k: int, alpha: float, offset: int) -> list:
+    """
+    Search the (query_embedding, query_text, tags) of many queries with batched Weaviate requests.
+    Returns one response per query, in the format of /query_top_k_documents.
+    """
+    embeddings = [embedding for embedding, _, _ in queries]
+    texts = [text for _, text, _ in queries]
+    COLLECTION_NAME = COLLECTIONS[model]
+
+    if model == 0 or model == 1:
+        res = VecMgr.batch_get_top_k(COLLECTION_NAME, embeddings, top_k, offset=offset)
+        return [{"results": r} for r in res]
+
+    elif model == 2:
+        res = VecMgr.batch_get_top_k_by_hybrid(COLLECTION_NAME, texts, embeddings, top_k, alpha, offset=offset)
+        return [{"results": r, "query_text": text, "image_tags": tags} for r, (_, text, tags) in zip(res, queries)]
+
+    elif model == 3:
+        text_res = VecMgr.batch_get_top_k_by_hybrid(COLLECTION_NAME['text'], texts, embeddings, top_k, alpha, offset=offset)
+        image_res = VecMgr.batch_get_top_k_by_hybrid(COLLECTION_NAME['image'], texts, embeddings, top_k, alpha, offset=offset)
+        return [
+            {"text_results": t, "image_results": i, "query_text": text, "image_tags": tags}
+            for t, i, (_, text, tags) in zip(text_res, image_res, queries)
+        ]
+
+    else:
+        raise Exception("Invalid model choice")
+
+
+async def run_batch_chunk(chunk: list, model: int, top_k: int, alpha: float, offset: int, caption_tier: Optional[str]) -> list:
+    """
+    Embed and search one chunk of a batch request, a list of (index, kind, query) with kind 'text' or 'image'.
+    Image queries are UploadFiles, read here so only one chunk of images is held in memory at a time.
+    Returns one result dictionary per query, with either the response of /query_top_k_documents or an error.
+    """
+    with_embedding, with_caption = plan_stages(model, alpha)
+    results = {
+        index: {"index": index, "text_query": query} if kind == 'text' else {"index": index, "image_file": query.filename}
+        for index, kind, query in chunk
+    }
+    generated = {} # index -> (query_embedding, query_text, tags)
+    try:
+        texts = [(index, query) for index, kind, query in chunk if kind == 'text']
+        if texts:
+            text_queries = await inference_executor.run(generate_text_queries, [query for _, query in texts], model, with_embedding=with_embedding)
+            for (index, _), (embedding, text) in zip(texts, text_queries):
+                generated[index] = (embedding, text, None)
+
+        images = []
+        for index, kind, query in chunk:
+            if kind != 'image':
+                continue
+            try:
+                image_content = await query.read(MAX_UPLOAD_BYTES + 1)
+            except (OSError, ValueError) as e:
+                # ValueError if the upload was already closed
+                results[index]["error"] = f"Could not read image: {e}"
+                continue
+            if len(image_content) > MAX_UPLOAD_BYTES:
+                results[index]["error"] = f"Image larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB"
+                continue
+            images.append((index, image_content))
+        if images:
+            image_queries = await inference_executor.run(generate_image_queries, [content for _, content in images], model, caption_tier,
+                                                         with_caption=with_caption, with_embedding=with_embedding, return_exceptions=True)
+            for (index, _), query in zip(images, image_queries):
+                if isinstance(query, Exception):
+                    results[index]["error"] = f"{query}"
+                else:
+                    generated[index] = query
+
+        if generated:
+            responses = await db_executor.run(batch_search, model, list(generated.values()), top_k, alpha, offset)
+            for index, response in zip(generated, responses):
+                results[index].update(response)
+
+    except Exception as e:
+        # e.g. a full queue or a model error, the search is the last step so none of the chunk's queries has results yet
+        for index, _, _ in chunk:
+            results[index].setdefault("error", e.detail if isinstance(e, HTTPException) else f"{e}")
+
+    return [results[index] for index, _, _ in chunk]
+
+
+@app.post("/batch_query")
+async def batch_query(text_queries: List[str] = Form(default=[]), image_files: List[UploadFile] = File(default=[]), top_k: int = 10, model: int = 0, alpha: float = 0.5, offset: int = 0, caption_tier: Optional[str] = None, stream: bool = False):
+    """
+    Queries the vector database for many text queries and/or images at once, with the same settings for all of them.
+    Queries are embedded in batched forwards and searched with batched requests, BATCH_QUERY_CHUNK_SIZE queries at a time.
+
+    INPUT: 
+    ------------------------------------
+    text_queries (List[str]): 
+                    Query strings, as repeated form fields.
+
+    image_files (List[UploadFile]): 
+                    Image files, as repeated multipart files.
+
+    top_k, model, alpha, offset, caption_tier:
+                    Same as /query_top_k_documents, shared by every query.
+
+    stream (bool):  
+                    Stream the results as newline-delimited JSON, one line per query as soon as its chunk is done,
+                    instead of returning them all at the end.
+
+    RETURNS: 
+    ------------------------------------
+        dict:       Results of every query, text queries first and then images, in the order they were sent.
+                    Each result holds the query's index, the query text or image file name, and either
+                    the response of /query_top_k_documents or an error.
+                    example: {
+                        "queries": [
+                            {
+                                "index": 0,
+                                "text_query": text_query,
+                                "results": results
+                            },
+                            {
+                                "index": 1,
+                                "image_file": image_file,
+                                "error": error
+                            },
+                            ...
+                        ]
+                    }
+    """
+    check_query_settings(model, caption_tier)
+
+    if len(text_queries) == 0 and len(image_files) == 0:
+        raise HTTPException(status_code=400, detail="No text queries or images provided")
+    # Images are read chunk by chunk. The form's files are closed by FastAPI's exit stack once the response is sent,
+    # after a streamed body too; should an upload be closed earlier, only its query reports an error.
+    queries = [('text', text_query) for text_query in text_queries] + [('image', image_file) for image_file in image_files]
+    queries = [(index, kind, query) for index, (kind, query) in enumerate(queries)]
+    chunks = [queries[start:start + BATCH_QUERY_CHUNK_SIZE] for start in range(0, len(queries), BATCH_QUERY_CHUNK_SIZE)]
+
+    if stream:
+        async def lines():
+            for chunk in chunks:
+                for result in await run_batch_chunk(chunk, model, top_k, alpha, offset, caption_tier):
+                    yield json.dumps(result) + "\n"
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    results = []
+    for chunk in chunks:
+        results += await run_batch_chunk(chunk, model, top_k, alpha, offset, caption_tier)
+    return {"queries": results}
@@ -1,77 +1,355 @@
 from .utils.ALIGNManager import ALIGNManager
 from .utils.MLPManager import MLPManager
+from .utils.BatchScheduler import BatchScheduler
+from .utils.CacheManager import CacheManager
+from .utils.ModelLoader import ModelLoader
 
 from models.ram.models import ram
 from models.ram.models import tag2text
-from models.ram import inference_ram
-from models.ram import inference_tag2text
+from models.ram import inference_caption
 from models.ram import get_transform
+from models.ram.models.utils import save_converted_checkpoint
 
+from PIL import Image
+from io import BytesIO
+
+import functools
+import hashlib
+import numpy as np
+import operator
 import torch
 import os
+import unicodedata
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
-mlp_model = MLPManager().to(device)
-mlp_model.load_state_dict(
-    torch.load(os.path.join(os.path.dirname(__file__), 'weights/align_mlp_checkpoint.pth'), 
-        map_location=device)
-)
-
-# MM Models
-align_model = ALIGNManager(device)
-
+MLP_WEIGHTS = os.path.join(os.path.dirname(__file__), 'weights/align_mlp_checkpoint.pth')
 RAM_WEIGHTS = os.path.join(os.path.dirname(__file__), 'weights/ram_swin_large_14m.pth')
 T2T_WEIGHTS = os.path.join(os.path.dirname(__file__), 'weights/tag2text_swin_14m.pth')
-
-# RAM
 IMAGE_SIZE = 384
-ram_model = ram(pretrained=RAM_WEIGHTS, image_size=IMAGE_SIZE, vit='swin_l')
-ram_model = ram_model.to(device)
-ram_model.eval()
 
-# T2T
-t2t_model = tag2text(pretrained=T2T_WEIGHTS, image_size=IMAGE_SIZE, vit='swin_b')
-t2t_model = t2t_model.to(device)
-t2t_model.threshold = 0.68 # value used in original repo
-t2t_model.eval()
 
+def converted_weights(path: str) -> str:
+    """
+    Path of the memory-mappable copy of a checkpoint written by convert_checkpoints().
+    """
+    return os.path.splitext(path)[0] + '.safetensors'
+
+
+def _weights(path: str) -> str:
+    # Prefer the converted checkpoint, it is mapped instead of unpickled and post-processed on every start
+    converted = converted_weights(path)
+    return converted if os.path.isfile(converted) else path
+
+
+# Models used by each query pipeline (see main.py). RAM and T2T are only needed for image queries.
+PIPELINES = {
+    0: ['align'],
+    1: ['align', 'mlp'],
+    2: ['align', 'mlp', 'ram', 't2t'],
+    3: ['align', 'ram', 't2t'],
+}
+# Pipelines this worker serves, e.g. SERVED_MODELS=0,1 for a lean text-only replica
+SERVED_MODELS = [int(model) for model in os.environ.get('SERVED_MODELS', '0,1,2,3').split(',') if model.strip()]
+
+# Models run with dynamic int8 quantization on CPU, e.g. QUANTIZE_MODELS=ram,t2t (see benchmark_quantization.py)
+QUANTIZED_MODELS = [name.strip() for name in os.environ.get('QUANTIZE_MODELS', '').split(',') if name.strip()]
+# Linear-heavy BERT stacks quantized in each model, the image encoders stay in fp32
+QUANTIZED_SUBMODULES = {
+    'align': ['model.text_model'],
+    'ram': ['tagging_head'],
+    't2t': ['tag_encoder', 'text_decoder'],
+}
+
+# Query texts are truncated to this many tokens, like the articles at indexing time (see ingest.py --max-text-tokens)
+QUERY_MAX_TOKENS = int(os.environ.get('QUERY_MAX_TOKENS', 64))
+
+# Approximate RAM tagging: only score this many labels shortlisted by similarity to the image, 0 scores all labels
+RAM_TAG_CANDIDATES = int(os.environ.get('RAM_TAG_CANDIDATES', 0))
+
+# Caption decoding settings, from fastest to best. The RAM and T2T image encoders cost the same in every tier,
+# the decoder's share grows with the number of beams (forwards per step) and max_length (number of steps).
+CAPTION_TIERS = {
+    # greedy decoding of short captions: the cheapest decode, captions are terser and more generic
+    'fast': {'num_beams': 1, 'max_length': 20, 'min_length': 5},
+    # Tag2Text's default beam search: 3x the decoder work of greedy per step, up to 30 tokens
+    'beam': {'num_beams': 3, 'max_length': 30, 'min_length': 10},
+    # beam search with up to 50 tokens, the original setting and the most detailed captions
+    'full': {'num_beams': 3, 'max_length': 50, 'min_length': 10},
+}
+# Tier used when a query does not ask for one
+CAPTION_TIER = os.environ.get('CAPTION_TIER', 'full')
+if CAPTION_TIER not in CAPTION_TIERS:
+    raise ValueError(f"Invalid CAPTION_TIER {CAPTION_TIER}, choose one of {list(CAPTION_TIERS)}")
+# Decoding deadline for query captions, once reached the best caption found so far is used. 0 for no deadline.
+CAPTION_DEADLINE = float(os.environ.get('CAPTION_DEADLINE_MS', 0)) / 1000 or None
+# Encoded image uploads are decoded at a reduced size when possible (see decode_image)
+MAX_DECODE_SIZE = 2 * IMAGE_SIZE
+
+
+def _fingerprint(*settings) -> str:
+    # Short hash of everything a cached model output depends on
+    return hashlib.sha256(repr(settings).encode()).hexdigest()[:12]
 
-def generate_caption(image) -> str:
+
+def _mtime(path: str) -> float:
+    return os.path.getmtime(path) if os.path.isfile(path) else None
+
+
+def _quantized(name: str) -> bool:
+    return name in QUANTIZED_MODELS and device == 'cpu'
+
+
+# Part of the query cache keys, so new weights or settings never get outputs cached (e.g. on disk) by the previous ones
+CACHE_FINGERPRINTS = {
+    'image': _fingerprint(ALIGNManager.MODEL_VERSION, _quantized('align')),
+    'text': _fingerprint(ALIGNManager.MODEL_VERSION, _quantized('align'), _mtime(MLP_WEIGHTS), QUERY_MAX_TOKENS),
+    'caption': _fingerprint(
+        IMAGE_SIZE, _mtime(_weights(RAM_WEIGHTS)), _mtime(_weights(T2T_WEIGHTS)),
+        _quantized('ram'), _quantized('t2t'), RAM_TAG_CANDIDATES,
+    ),
+}
+
+
+def _quantize(name: str, model, quantized: bool = None):
     """
-    Generate caption from image using Recognize Anything Model (RAM) and Tag2Text (T2T) model.
+    Swap the nn.Linear layers of the model's BERT stacks for dynamic int8 ones: weights are stored in int8
+    and activations are quantized on the fly, so matmuls run in int8 on CPU.
+
+    INPUT:
+    ------------------------------------
+    name (str):
+                        One of 'align', 'ram' or 't2t'.
+
+    model:
+                        The loaded model, quantized in place.
+
+    quantized (bool):
+                        Whether to quantize. Defaults to whether the model is listed in QUANTIZE_MODELS.
+
+    RETURNS:
+    ------------------------------------
+    model:
+                        The same model.
+    """
+    if quantized is None:
+        quantized = name in QUANTIZED_MODELS
+    if not quantized:
+        return model
+    if device != 'cpu':
+        print(f"Not quantizing {name}, dynamic int8 quantization only runs on CPU")
+        return model
+    for submodule in QUANTIZED_SUBMODULES[name]:
+        torch.quantization.quantize_dynamic(operator.attrgetter(submodule)(model), {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    print(f"Quantized {name} model")
+    return model
+
+
+def _load_mlp():
+    mlp_model = MLPManager().to(device)
+    mlp_model.load_state_dict(torch.load(MLP_WEIGHTS, map_location=device))
+    return mlp_model.eval()
+
+
+def _load_align(quantized: bool = None):
+    return _quantize('align', ALIGNManager(device), quantized)
+
+
+def _load_ram(weights: str = None, quantized: bool = None):
+    ram_model = ram(pretrained=weights or _weights(RAM_WEIGHTS), image_size=IMAGE_SIZE, vit='swin_l', inference_only=True)
+    ram_model.tag_candidates = RAM_TAG_CANDIDATES
+    return _quantize('ram', ram_model.to(device).eval().freeze(), quantized)
+
+
+def _load_t2t(weights: str = None, quantized: bool = None):
+    t2t_model = tag2text(pretrained=weights or _weights(T2T_WEIGHTS), image_size=IMAGE_SIZE, vit='swin_b')
+    t2t_model = t2t_model.to(device)
+    t2t_model.threshold = 0.68 # value used in original repo
+    return _quantize('t2t', t2t_model.eval(), quantized)
+
+
+# Each model is loaded the first time a request needs it
+model_loaders = {
+    'mlp': ModelLoader('mlp', _load_mlp),
+    'align': ModelLoader('align', _load_align),
+    'ram': ModelLoader('ram', _load_ram),
+    't2t': ModelLoader('t2t', _load_t2t),
+}
+
+
+def get_model(name: str):
+    """
+    Return one of the 'align', 'mlp', 'ram' or 't2t' models, loading it on first use.
+    """
+    return model_loaders[name].get()
+
+
+def load_model(name: str, quantized: bool = None):
+    """
+    Build a new instance of the 'align', 'ram' or 't2t' model, e.g. to compare fp32 and int8 versions.
+    Unlike get_model(), the instance is not shared.
+    """
+    return {'align': _load_align, 'ram': _load_ram, 't2t': _load_t2t}[name](quantized=quantized)
+
+
+def preload(models=None) -> None:
+    """
+    Load every model used by the given pipelines up front, instead of on the first request.
+
+    INPUT:
+    ------------------------------------
+    models (List[int]):
+                        Pipelines to load the models of. Defaults to the pipelines this worker serves.
+    """
+    models = SERVED_MODELS if models is None else models
+    for name in dict.fromkeys(name for model in models for name in PIPELINES[model]):
+        get_model(name)
+
+
+def convert_checkpoints() -> None:
+    """
+    Convert the RAM and T2T checkpoints once into memory-mappable safetensors files next to the original
+    .pth files. Later loads map the converted files zero-copy, so startup skips unpickling the full
+    checkpoints and re-interpolating the Swin position tables, and workers share one copy of the weights.
+    Delete the .safetensors files to go back to the original checkpoints.
+    """
+    for load, weights in [(_load_ram, RAM_WEIGHTS), (_load_t2t, T2T_WEIGHTS)]:
+        model = load(weights, quantized=False)
+        save_converted_checkpoint(model, converted_weights(weights))
+        del model
+
+
+def decode_image(data: bytes) -> Image.Image:
+    """
+    Decode an uploaded image once, for every model. Large JPEGs are decoded at 1/2, 1/4 or 1/8 scale directly
+    by the decoder (draft mode), as long as the result stays at least MAX_DECODE_SIZE on both sides, which is
+    much faster than decoding the full photo and then resizing it for each model.
+    """
+    image = Image.open(BytesIO(data))
+    image.draft('RGB', (MAX_DECODE_SIZE, MAX_DECODE_SIZE))
+    return image.convert('RGB')
+
+
+def generate_captions(images, tier: str = 'full', deadline: float = None, return_complete: bool = False) -> list:
+    """
+    Generate captions for a batch of images using Recognize Anything Model (RAM) and Tag2Text (T2T) model.
 
     INPUT:
     ------------------------------------
-    image (PIL.Image): 
-                        Image to generate caption from.
+    images (List[PIL.Image] or List[torch.Tensor]): 
+                        Images to generate captions from, or their get_transform(IMAGE_SIZE) tensors.
+
+    tier (str):
+                        Caption decoding settings, one of CAPTION_TIERS.
+
+    deadline (float):
+                        Decoding deadline in seconds, once reached the best captions found so far are returned.
+
+    return_complete (bool):
+                        Also return whether each caption was decoded without the deadline possibly cutting it short.
     
     RETURNS:
     ------------------------------------
-    caption (str):      
-                        Generated caption.
+    captions (List[Tuple[str, str]] or List[Tuple[str, str, bool]]):      
+                        Generated (caption, tags) pair for each image, or (caption, tags, complete) with return_complete.
     """
     transform = get_transform(image_size=IMAGE_SIZE)
-    image = transform(image).unsqueeze(0).to(device)
+    images = torch.stack([image if isinstance(image, torch.Tensor) else transform(image) for image in images]).to(device)
+
+    # one Swin-L (RAM) and one Swin-B (T2T) pass
+    tags, captions, timed_out = inference_caption(images, get_model('ram'), get_model('t2t'), return_timed_out=True,
+                                                  max_time=deadline, **CAPTION_TIERS[tier])
+
+    if return_complete:
+        return [(caption, tag, not cut) for caption, tag, cut in zip(captions, tags, timed_out)]
+    return list(zip(captions, tags))
+
+
+def _split_rows(embeddings) -> list:
+    # Keep the (1, embedding_dim) shape the single-item helpers have always returned
+    return [embeddings[i:i + 1] for i in range(len(embeddings))]
+
+
+# Coalesce concurrent queries into batched forwards
+batch_scheduler = BatchScheduler(
+    {
+        'text': lambda texts: _split_rows(get_model('align').get_text_embeddings(texts, max_length=QUERY_MAX_TOKENS)),
+        'image': lambda pixel_values: _split_rows(get_model('align').get_pixel_embeddings(torch.cat(pixel_values))),
+        # captions of different tiers are decoded with different settings, so they are batched separately
+        **{f'caption:{tier}': functools.partial(generate_captions, tier=tier, deadline=CAPTION_DEADLINE, return_complete=True) for tier in CAPTION_TIERS},
+    },
+    window_ms=float(os.environ.get('INFERENCE_BATCH_WINDOW_MS', 5)),
+    max_batch_size=int(os.environ.get('INFERENCE_MAX_BATCH_SIZE', 16)),
+)
+
+
+# Repeated queries skip inference. QUERY_CACHE_PATH adds an on-disk tier that survives restarts.
+query_cache = CacheManager(
+    max_size=int(os.environ.get('QUERY_CACHE_SIZE', 1024)),
+    ttl=float(os.environ.get('QUERY_CACHE_TTL', 0)),
+    disk_path=os.environ.get('QUERY_CACHE_PATH') or None,
+)
 
-    tags = inference_ram(image, ram_model)
-    _, _, caption = inference_tag2text(image, t2t_model, tags) # [Model identified tags, RAM generated tags, caption]
 
+def generate_caption(image, tier: str = None) -> str:
+    """
+    Generate caption from image using Recognize Anything Model (RAM) and Tag2Text (T2T) model.
+    Concurrent calls are batched together by the batch scheduler.
+
+    INPUT:
+    ------------------------------------
+    image (PIL.Image or torch.Tensor): 
+                        Image to generate caption from, or its get_transform(IMAGE_SIZE) tensor.
+
+    tier (str):
+                        Caption decoding settings, one of CAPTION_TIERS. Defaults to CAPTION_TIER.
+    
+    RETURNS:
+    ------------------------------------
+    caption (str):      
+                        Generated caption.
+    """
+    caption, tags, _ = batch_scheduler.run(f'caption:{tier or CAPTION_TIER}', image)
     return caption, tags
     
 
-def generate_image_query(query, model):
+def _image_key(image) -> str:
+    # Content hash of the uploaded bytes, or of the pixels when given an already decoded image
+    if isinstance(image, bytes):
+        return hashlib.sha256(image).hexdigest()
+    return hashlib.sha256(f"{image.mode}{image.size}".encode() + image.tobytes()).hexdigest()
+
+
+def _normalize_text(text: str) -> str:
+    # ALIGN's BERT tokenizer is uncased and splits on whitespace, so case and spacing do not change the embedding
+    return " ".join(unicodedata.normalize("NFC", text).lower().split())
+
+
+def generate_image_query(query, model, caption_tier=None, with_caption=True, with_embedding=True):
     """
     Generate image query from image using the specified model.
+    Embeddings, captions and tags are cached by the content hash of the image and the models' CACHE_FINGERPRINTS.
+    On a cache miss the image is decoded once, and the inputs of ALIGN and of RAM/T2T are both derived from it.
+    The caption and the embedding are independent, so they are computed concurrently by their batch workers.
 
     INPUT:
     ------------------------------------
-    query (PIL.Image):
-                        Query image.
+    query (bytes or PIL.Image):
+                        Query image, either the encoded file contents or a decoded image.
     
     model (int):
                         Model to use for query. If model involved hybrid search, a caption will be generated.
 
+    caption_tier (str):
+                        Caption decoding settings, one of CAPTION_TIERS. Defaults to CAPTION_TIER.
+
+    with_caption (bool):
+                        Whether to generate the caption of hybrid models, e.g. not for a pure vector search (alpha 1).
+
+    with_embedding (bool):
+                        Whether to embed the image, e.g. not for a pure keyword search (alpha 0).
+                        Skipped stages return None.
+
     RETURNS:
     ------------------------------------
     query_embedding (np.ndarray):
@@ -81,18 +359,97 @@ def generate_image_query(query, model):
                         Caption generated by Recognize Anything Model (RAM) and Tag2Text (T2T) model.
 
     """
+    return generate_image_queries([query], model, caption_tier, with_caption, with_embedding)[0]
+
+
+def generate_image_queries(queries, model, caption_tier=None, with_caption=True, with_embedding=True, return_exceptions=False) -> list:
+    """
+    Generate image queries for a batch of images, like generate_image_query.
+    Every cache miss is preprocessed first and then queued before waiting on any, so the batch scheduler runs them
+    in as few forwards as possible.
+
+    INPUT:
+    ------------------------------------
+    queries (List[bytes] or List[PIL.Image]):
+                        Query images, either the encoded file contents or decoded images.
+
+    model, caption_tier, with_caption, with_embedding:
+                        Same as generate_image_query.
+
+    return_exceptions (bool):
+                        Return the exception of a failed query (e.g. an image that cannot be decoded) in its place
+                        instead of raising it.
+
+    RETURNS:
+    ------------------------------------
+    queries (List[Tuple[np.ndarray, str, str]]):
+                        (query_embedding, caption, tags) of each image, as returned by generate_image_query.
+    """
+    if model not in SERVED_MODELS:
+        raise KeyError("Invalid model selection")
+
+    tier = caption_tier or CAPTION_TIER
+    if tier not in CAPTION_TIERS:
+        raise KeyError(f"Invalid caption tier: {tier}")
+
+    results = []
+    pending = [] # (index, key, caption input, embedding input) of the cache misses
+    for query in queries:
+        key = _image_key(query)
+        caption_tags = query_cache.get(f"caption|{CACHE_FINGERPRINTS['caption']}|{tier}|{key}") if with_caption and (model == 2 or model == 3) else (None, None)
+        embedding = query_cache.get(f"image|{CACHE_FINGERPRINTS['image']}|{key}") if with_embedding else False
 
-    if model == 2 or model == 3:
-        caption, tags = generate_caption(query)
-    else:
-        caption = None
-        tags = None
-    return align_model.get_single_image_embedding(query), caption, tags
+        if caption_tags is None or embedding is None:
+            try:
+                # Only decoded on a cache miss. Preprocessing runs here, on the request's thread, so the batch workers only run forwards.
+                image = decode_image(query) if isinstance(query, bytes) else query.convert('RGB')
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                results.append(e)
+                continue
+            caption_input = get_transform(image_size=IMAGE_SIZE)(image) if caption_tags is None else None
+            embedding_input = get_model('align').preprocess_images([image]) if embedding is None else None
+            pending.append((len(results), key, caption_input, embedding_input))
+
+        results.append((embedding if with_embedding else None, caption_tags))
+
+    # Every job is queued before waiting on any: the caption and the embedding of an image run concurrently
+    # on their own batch workers, and the images of a batch share forwards
+    pending = [
+        (
+            i, key,
+            batch_scheduler.submit(f'caption:{tier}', caption_input) if caption_input is not None else None,
+            batch_scheduler.submit('image', embedding_input) if embedding_input is not None else None,
+        )
+        for i, key, caption_input, embedding_input in pending
+    ]
+    for i, key, caption_future, embedding_future in pending:
+        embedding, caption_tags = results[i]
+        try:
+            if embedding_future is not None:
+                embedding = embedding_future.result()
+                query_cache.set(f"image|{CACHE_FINGERPRINTS['image']}|{key}", embedding)
+            if caption_future is not None:
+                caption, tags, complete = caption_future.result()
+                caption_tags = (caption, tags)
+                # A caption the deadline may have cut short (e.g. under load) is used once but not cached
+                if complete:
+                    query_cache.set(f"caption|{CACHE_FINGERPRINTS['caption']}|{tier}|{key}", caption_tags)
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            results[i] = e
+            continue
+        results[i] = (embedding, caption_tags)
+
+    return [result if isinstance(result, Exception) else (result[0], *result[1]) for result in results]
     
 
-def generate_text_query(query, model):
+def generate_text_query(query, model, with_embedding=True):
     """
     Generate text query from text using the specified model.
+    Embeddings are cached by the normalized text, model and the models' CACHE_FINGERPRINTS.
 
     INPUT:
     ------------------------------------
@@ -103,6 +460,9 @@ def generate_text_query(query, model):
                         Model to use for query.
                         0 for ALIGN, 1 for ALIGN + MLP, 2 for ALIGN + MLP + Hybrid, 3 for ALIGN + Hybrid + Split.
                         If model consists of MLP, the text query is first passed through the MLP model to generate an embedding.
+
+    with_embedding (bool):
+                        Whether to embed the text, e.g. not for a pure keyword search (alpha 0). The embedding is None if skipped.
     
     RETURNS:
     ------------------------------------
@@ -112,12 +472,45 @@ def generate_text_query(query, model):
     query (str):
                         Query text.
     """
-    if model == 1 or model == 2:
-        tensor = mlp_model(torch.tensor(align_model.get_single_text_embedding(query))).detach().cpu().numpy()
-        return tensor, query
-    elif model == 0 or model == 3:
-        return align_model.get_single_text_embedding(query), query
-    else:
+    return generate_text_queries([query], model, with_embedding)[0]
+
+
+def generate_text_queries(queries, model, with_embedding=True) -> list:
+    """
+    Generate text queries for a batch of texts, like generate_text_query.
+    Every cache miss is queued before waiting on any, so the batch scheduler runs them in as few forwards as possible.
+
+    INPUT:
+    ------------------------------------
+    queries (List[str]):
+                        Query texts.
+
+    model, with_embedding:
+                        Same as generate_text_query.
+
+    RETURNS:
+    ------------------------------------
+    queries (List[Tuple[np.ndarray, str]]):
+                        (query_embedding, query) of each text, as returned by generate_text_query.
+    """
+    if model not in SERVED_MODELS:
         raise KeyError("Invalid model selection")
+    if not with_embedding:
+        return [(None, query) for query in queries]
+
+    keys = [f"text|{CACHE_FINGERPRINTS['text']}|{model}|{_normalize_text(query)}" for query in queries]
+    embeddings = [query_cache.get(key) for key in keys]
+    misses = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    futures = [batch_scheduler.submit('text', queries[i]) for i in misses]
+    computed = [future.result() for future in futures]
+    if len(computed) > 0 and (model == 1 or model == 2):
+        with torch.inference_mode(): # no autograd graph for query-time forwards
+            computed = _split_rows(get_model('mlp')(torch.tensor(np.concatenate(computed))).cpu().numpy())
+    for i, embedding in zip(misses, computed):
+        embeddings[i] = embedding
+        query_cache.set(keys[i], embedding)
+    return list(zip(embeddings, queries))
+
 
-print("Models loaded")
\ No newline at end of file
+if os.environ.get('PRELOAD_MODELS', 'false').lower() == 'true':
+    preload()
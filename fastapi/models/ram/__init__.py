@@ -1,2 +1,2 @@
-from .inference import inference_tag2text, inference_ram, inference_ram_openset
+from .inference import inference_tag2text, inference_ram, inference_ram_openset, inference_caption
 from .transform import get_transform
@@ -2,6 +2,8 @@
  * The Inference of RAM and Tag2Text Models
  * Written by Xinyu Huang
 '''
+import time
+
 import torch
 
 
@@ -30,6 +32,62 @@ def inference_tag2text(image, model, input_tag="None"):
         return tag_predict[0], input_tag[0], caption[0]
 
 
+def inference_caption(image, ram_model, t2t_model, max_length=50, return_timed_out=False, **generate_kwargs):
+    """
+    RAM tagging followed by Tag2Text captioning conditioned on the RAM tags.
+
+    Equivalent to inference_ram followed by inference_tag2text for every image
+    in the batch, but each backbone encodes the batch once: the tag-free
+    Tag2Text pass is only run for images where RAM finds no tags, since its
+    caption is otherwise discarded.
+
+    Other keyword arguments (num_beams, min_length, max_time, ...) are passed
+    on to Tag2Text.generate.
+
+    Returns a list of RAM tags and a list of captions, one per image. With
+    return_timed_out, also returns whether each caption may have been cut
+    short by the max_time deadline.
+    """
+    max_time = generate_kwargs.get('max_time')
+    timed_out = [False] * len(image)
+
+    with torch.no_grad():
+        tags = ram_model.generate_tag(image)
+        captions = [None] * len(tags)
+
+        tagged = [i for i, tag in enumerate(tags) if tag not in ('', 'none', 'None')]
+        untagged = [i for i in range(len(tags)) if i not in tagged]
+
+        if tagged:
+            tag_input = [tags[i].replace(',', ' | ') for i in tagged]
+            started = time.monotonic()
+            caption = t2t_model.generate(image[tagged],
+                                         tag_input=tag_input,
+                                         max_length=max_length,
+                                         **generate_kwargs)
+            # generate does not say whether max_time stopped it, a call lasting that long may have been
+            hit = max_time is not None and time.monotonic() - started >= max_time
+            for i, c in zip(tagged, caption):
+                captions[i] = c
+                timed_out[i] = hit
+
+        if untagged:
+            started = time.monotonic()
+            caption, _ = t2t_model.generate(image[untagged],
+                                            tag_input=None,
+                                            max_length=max_length,
+                                            return_tag_predict=True,
+                                            **generate_kwargs)
+            hit = max_time is not None and time.monotonic() - started >= max_time
+            for i, c in zip(untagged, caption):
+                captions[i] = c
+                timed_out[i] = hit
+
+    if return_timed_out:
+        return tags, captions, timed_out
+    return tags, captions
+
+
 def inference_ram(image, model):
 
     with torch.no_grad():
@@ -206,7 +206,12 @@ class BertSelfAttention(nn.Module):
         # such that the encoder's padding tokens are not attended to.
         is_cross_attention = encoder_hidden_states is not None
 
-        if is_cross_attention:
+        if is_cross_attention and past_key_value is not None:
+            # the encoder sequence does not change while decoding, reuse the keys/values projected on the first step
+            key_layer = past_key_value[0]
+            value_layer = past_key_value[1]
+            attention_mask = encoder_attention_mask
+        elif is_cross_attention:
             # print(self.key.weight.shape)
             key_layer = self.transpose_for_scores(self.key(encoder_hidden_states))
             value_layer = self.transpose_for_scores(self.value(encoder_hidden_states))
@@ -230,6 +235,17 @@ class BertSelfAttention(nn.Module):
             attention_mask = attention_mask[:query_layer.shape[0], :, :]
             value_layer = value_layer[:query_layer.shape[0], :, :, :]
 
+        # encoder states shared by several beams (see BertLMHeadModel._expand_inputs_for_generation): group the
+        # beams of each input in an extra dimension, so its keys/values are broadcast over them instead of copied
+        beams = 1
+        if is_cross_attention and query_layer.shape[0] > key_layer.shape[0]:
+            beams = query_layer.shape[0] // key_layer.shape[0]
+            query_layer = query_layer.view(key_layer.shape[0], beams, *query_layer.shape[1:])
+            key_layer = key_layer.unsqueeze(1)
+            value_layer = value_layer.unsqueeze(1)
+            if attention_mask is not None:
+                attention_mask = attention_mask.unsqueeze(1)
+
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
 
@@ -270,6 +286,9 @@ class BertSelfAttention(nn.Module):
             attention_probs_dropped = attention_probs_dropped * head_mask
 
         context_layer = torch.matmul(attention_probs_dropped, value_layer)
+        if beams > 1:
+            context_layer = context_layer.flatten(0, 1)
+            attention_probs = attention_probs.flatten(0, 1)
 
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
@@ -433,16 +452,20 @@ class BertLayer(nn.Module):
             if mode=='multimodal':
                 assert encoder_hidden_states is not None, "encoder_hidden_states must be given for cross-attention layers"
 
+                # cross-attention cached key/values tuple is at positions 3,4 of past_key_value tuple
+                cross_attn_past_key_value = past_key_value[2:] if past_key_value is not None and len(past_key_value) == 4 else None
                 cross_attention_outputs = self.crossattention(
                     attention_output,
                     attention_mask,
                     head_mask,
                     encoder_hidden_states,
                     encoder_attention_mask,
+                    past_key_value=cross_attn_past_key_value,
                     output_attentions=output_attentions,
                 )
                 attention_output = cross_attention_outputs[0]
                 outputs = outputs + cross_attention_outputs[1:-1]  # add cross attentions if we output attention weights                               
+                present_key_value = present_key_value + cross_attention_outputs[-1]
         layer_output = apply_chunking_to_forward(
             self.feed_forward_chunk, self.chunk_size_feed_forward, self.seq_len_dim, attention_output
         )
@@ -1007,7 +1030,9 @@ class BertLMHeadModel(BertPreTrainedModel):
             cross_attentions=outputs.cross_attentions,
         )
 
-    def prepare_inputs_for_generation(self, input_ids, past=None, attention_mask=None, **model_kwargs):
+    def prepare_inputs_for_generation(self, input_ids, past_key_values=None, attention_mask=None, past=None, **model_kwargs):
+        # newer versions of transformers pass the cache as past_key_values, older ones as past
+        past = past_key_values if past_key_values is not None else past
         input_shape = input_ids.shape
         # if model is used as a decoder in encoder-decoder model, the decoder attention mask is created on the fly
         if attention_mask is None:
@@ -1026,10 +1051,25 @@ class BertLMHeadModel(BertPreTrainedModel):
             "is_decoder": True,
         }
 
+    @staticmethod
+    def _expand_inputs_for_generation(expand_size=1, is_encoder_decoder=False, input_ids=None, **model_kwargs):
+        # generate() copies every input num_beams times. The encoder states are the same for all beams of an
+        # input, so keep one row per input; cross-attention broadcasts them (and their cached keys/values) over the beams.
+        # Their mask stays at one row per input as well, so it is broadcast the same way.
+        encoder_hidden_states = model_kwargs.pop("encoder_hidden_states", None)
+        encoder_attention_mask = model_kwargs.pop("encoder_attention_mask", None)
+        input_ids, model_kwargs = PreTrainedModel._expand_inputs_for_generation(
+            expand_size=expand_size, is_encoder_decoder=is_encoder_decoder, input_ids=input_ids, **model_kwargs
+        )
+        model_kwargs["encoder_hidden_states"] = encoder_hidden_states
+        model_kwargs["encoder_attention_mask"] = encoder_attention_mask
+        return input_ids, model_kwargs
+
     def _reorder_cache(self, past, beam_idx):
         reordered_past = ()
         for layer_past in past:
-            reordered_past += (tuple(past_state.index_select(0, beam_idx) for past_state in layer_past),)
+            # cached cross-attention key/values are the same for every beam of an input, only self-attention ones need reordering
+            reordered_past += (tuple(past_state.index_select(0, beam_idx) for past_state in layer_past[:2]) + layer_past[2:],)
         return reordered_past
 
 
@@ -26,7 +26,8 @@ class RAM(nn.Module):
                  threshold=0.68,
                  delete_tag_index=[],
                  tag_list=f'{CONFIG_PATH}/data/ram_tag_list.txt',
-                 tag_list_chinese=f'{CONFIG_PATH}/data/ram_tag_list_chinese.txt'):
+                 tag_list_chinese=f'{CONFIG_PATH}/data/ram_tag_list_chinese.txt',
+                 inference_only=False):
         r""" The Recognize Anything Model (RAM) inference module.
         RAM is a strong image tagging model, which can recognize any common category with high accuracy.
         Described in the paper " Recognize Anything: A Strong Image Tagging Model" https://recognize-anything.github.io/
@@ -37,8 +38,11 @@ class RAM(nn.Module):
             vit (str): model size of vision transformer
             threshold (int): tagging threshold
             delete_tag_index (list): delete some tags that may disturb captioning
+            inference_only (bool): only build the modules generate_tag uses, skipping the tokenizer,
+                                   the image-tag interaction encoder, the text decoder and the chinese tag list
         """
         super().__init__()
+        self.inference_only = inference_only
 
         # create image encoder
         if vit == 'swin_b':
@@ -98,36 +102,42 @@ class RAM(nn.Module):
             self.visual_encoder, vision_width = create_vit(
                 vit, image_size, vit_grad_ckpt, vit_ckpt_layer)
 
-        # create tokenzier
-        self.tokenizer = init_tokenizer()
+        if not inference_only:
+            # create tokenzier
+            self.tokenizer = init_tokenizer()
 
-        # Tag2Text employ encoder-decoder architecture for image-tag-text generation: image-tag interaction encoder and image-tag-text decoder
-        # create image-tag interaction encoder
-        encoder_config = BertConfig.from_json_file(med_config)
-        encoder_config.encoder_width = 512
-        self.tag_encoder = BertModel(config=encoder_config,
-                                     add_pooling_layer=False)
+            # Tag2Text employ encoder-decoder architecture for image-tag-text generation: image-tag interaction encoder and image-tag-text decoder
+            # create image-tag interaction encoder
+            encoder_config = BertConfig.from_json_file(med_config)
+            encoder_config.encoder_width = 512
+            self.tag_encoder = BertModel(config=encoder_config,
+                                         add_pooling_layer=False)
 
-        # create image-tag-text decoder
-        decoder_config = BertConfig.from_json_file(med_config)
-        self.text_decoder = BertLMHeadModel(config=decoder_config)
+            # create image-tag-text decoder
+            decoder_config = BertConfig.from_json_file(med_config)
+            self.text_decoder = BertLMHeadModel(config=decoder_config)
 
         self.delete_tag_index = delete_tag_index
         self.prompt = prompt
-        self.prompt_length = len(self.tokenizer(self.prompt).input_ids) - 1
+        if not inference_only:
+            self.prompt_length = len(self.tokenizer(self.prompt).input_ids) - 1
 
         # load tag list
         self.tag_list = self.load_tag_list(tag_list)
-        self.tag_list_chinese = self.load_tag_list(tag_list_chinese)
+        self.tag_list_chinese = self.load_tag_list(tag_list_chinese) if not inference_only else None
 
         # create image-tag recognition decoder
         self.threshold = threshold
+        # number of labels shortlisted for the tagging head by generate_tag, None runs it on all labels
+        self.tag_candidates = None
         self.num_class = len(self.tag_list)
         q2l_config = BertConfig.from_json_file(f'{CONFIG_PATH}/configs/q2l_config.json')
         q2l_config.encoder_width = 512
         self.tagging_head = BertModel(config=q2l_config,
                                       add_pooling_layer=False)
-        self.tagging_head.resize_token_embeddings(len(self.tokenizer))
+        if not inference_only:
+            # the word embeddings are deleted by del_selfattention below, their size does not matter for tagging
+            self.tagging_head.resize_token_embeddings(len(self.tokenizer))
         # self.label_embed = nn.Embedding(self.num_class, q2l_config.hidden_size)
         self.label_embed = nn.Parameter(torch.zeros(self.num_class, q2l_config.encoder_width))
 
@@ -141,18 +151,27 @@ class RAM(nn.Module):
         self.del_selfattention()
 
         # share weights of the lowest 2-layer of "image-tag interaction encoder" with the "image-tag recogntion decoder"
-        tie_encoder_decoder_weights(self.tag_encoder, self.tagging_head, '',
-                                    ' ')
+        if not inference_only:
+            tie_encoder_decoder_weights(self.tag_encoder, self.tagging_head, '',
+                                        ' ')
         self.image_proj = nn.Linear(vision_width, 512)
         # self.label_embed = nn.Parameter(torch.load(f'{CONFIG_PATH}/data/textual_label_embedding.pth',map_location='cpu').float())
 
         # adjust thresholds for some tags
-        self.class_threshold = torch.ones(self.num_class) * self.threshold
+        class_threshold = torch.ones(self.num_class) * self.threshold
         ram_class_threshold_path = f'{CONFIG_PATH}/data/ram_tag_list_threshold.txt'
         with open(ram_class_threshold_path, 'r', encoding='utf-8') as f:
             ram_class_threshold = [float(s.strip()) for s in f]
         for key,value in enumerate(ram_class_threshold):
-            self.class_threshold[key] = value
+            class_threshold[key] = value
+        # buffers follow the model to its device, they are not part of the checkpoint
+        self.register_buffer('class_threshold', class_threshold, persistent=False)
+        tag_keep = torch.ones(self.num_class, dtype=torch.bool)
+        tag_keep[self.delete_tag_index] = False
+        self.register_buffer('tag_keep', tag_keep, persistent=False)
+        # projected and normalized label embeddings, precomputed by freeze()
+        self.register_buffer('frozen_label_embed', None, persistent=False)
+        self.register_buffer('frozen_label_norm', None, persistent=False)
 
     def load_tag_list(self, tag_list_file):
         with open(tag_list_file, 'r', encoding="utf-8") as f:
@@ -166,13 +185,46 @@ class RAM(nn.Module):
         for layer in self.tagging_head.encoder.layer:
             del layer.attention
 
+    def freeze(self):
+        """
+        Precompute the projected label embeddings once for inference, instead of on every generate_tag call.
+        Call again after changing the weights.
+        """
+        with torch.no_grad():
+            self.frozen_label_embed = torch.nn.functional.relu(self.wordvec_proj(self.label_embed))
+            self.frozen_label_norm = torch.nn.functional.normalize(self.label_embed, dim=-1)
+        return self
+
+    def get_label_embed(self):
+        if self.frozen_label_embed is not None:
+            return self.frozen_label_embed
+        return torch.nn.functional.relu(self.wordvec_proj(self.label_embed))
+
+    def shortlist_labels(self, image_cls_embeds, candidates):
+        """
+        Indices (bs, candidates) of the labels whose embedding is most similar to each image CLS embedding,
+        a cheap approximation of the labels the tagging head would pick.
+        """
+        label_norm = self.frozen_label_norm
+        if label_norm is None:
+            label_norm = torch.nn.functional.normalize(self.label_embed, dim=-1)
+        scores = torch.nn.functional.normalize(image_cls_embeds, dim=-1) @ label_norm.t()
+        scores = scores.masked_fill(~self.tag_keep, float('-inf'))
+        return scores.topk(candidates, dim=-1).indices
+
     def generate_tag(self,
                  image,
                  threshold=0.68,
                  tag_input=None,
+                 return_probs=False,
+                 candidates=None,
                  ):
+        """
+        candidates (int): approximate mode, only run the tagging head on this many labels shortlisted by
+                          shortlist_labels. Defaults to self.tag_candidates, None or 0 runs it on all labels.
+        """
             
-        label_embed = torch.nn.functional.relu(self.wordvec_proj(self.label_embed))
+        label_embed = self.get_label_embed()
 
         image_embeds = self.image_proj(self.visual_encoder(image))
         image_atts = torch.ones(image_embeds.size()[:-1],
@@ -183,7 +235,15 @@ class RAM(nn.Module):
         image_spatial_embeds = image_embeds[:, 1:, :]
 
         bs = image_spatial_embeds.shape[0]
-        label_embed = label_embed.unsqueeze(0).repeat(bs, 1, 1)
+        candidates = self.tag_candidates if candidates is None else candidates
+        if candidates and candidates < self.num_class:
+            # label queries do not attend to each other in the tagging head, so the shortlisted labels
+            # get the same probabilities as in the full mode; the other labels are never tagged
+            label_index = self.shortlist_labels(image_cls_embeds, candidates)
+            label_embed = label_embed[label_index]
+        else:
+            label_index = None
+            label_embed = label_embed.unsqueeze(0).expand(bs, -1, -1)
         tagging_embed = self.tagging_head(
             encoder_embeds=label_embed,
             encoder_hidden_states=image_embeds,
@@ -193,20 +253,13 @@ class RAM(nn.Module):
         )
 
         logits = self.fc(tagging_embed[0]).squeeze(-1)
+        probs = torch.sigmoid(logits)
+        if label_index is not None:
+            probs = torch.zeros(bs, self.num_class, dtype=probs.dtype, device=probs.device).scatter_(1, label_index, probs)
 
-        targets = torch.where(
-            torch.sigmoid(logits) > self.class_threshold.to(image.device),
-            torch.tensor(1.0).to(image.device),
-            torch.zeros(self.num_class).to(image.device))
-
-        tag = targets.cpu().numpy()
-        tag[:,self.delete_tag_index] = 0
-        tag_output = []
-        for b in range(bs):
-            index = np.argwhere(tag[b] == 1)
-            token = self.tag_list[index].squeeze(axis=1)
-            tag_output.append(' | '.join(token))
-
+        tag_output, tag_probs = decode_tags(probs, self.class_threshold, self.tag_keep, self.tag_list)
+        if return_probs:
+            return tag_output, tag_probs
 
         return tag_output
 
@@ -214,9 +267,10 @@ class RAM(nn.Module):
                  image,
                  threshold=0.68,
                  tag_input=None,
+                 return_probs=False,
                  ):
             
-        label_embed = torch.nn.functional.relu(self.wordvec_proj(self.label_embed))
+        label_embed = self.get_label_embed()
 
         image_embeds = self.image_proj(self.visual_encoder(image))
         image_atts = torch.ones(image_embeds.size()[:-1],
@@ -227,7 +281,7 @@ class RAM(nn.Module):
         image_spatial_embeds = image_embeds[:, 1:, :]
 
         bs = image_spatial_embeds.shape[0]
-        label_embed = label_embed.unsqueeze(0).repeat(bs, 1, 1)
+        label_embed = label_embed.unsqueeze(0).expand(bs, -1, -1)
         tagging_embed = self.tagging_head(
             encoder_embeds=label_embed,
             encoder_hidden_states=image_embeds,
@@ -238,18 +292,9 @@ class RAM(nn.Module):
 
         logits = self.fc(tagging_embed[0]).squeeze(-1)
 
-        targets = torch.where(
-            torch.sigmoid(logits) > self.class_threshold.to(image.device),
-            torch.tensor(1.0).to(image.device),
-            torch.zeros(self.num_class).to(image.device))
-
-        tag = targets.cpu().numpy()
-        tag[:,self.delete_tag_index] = 0
-        tag_output = []
-        for b in range(bs):
-            index = np.argwhere(tag[b] == 1)
-            token = self.tag_list[index].squeeze(axis=1)
-            tag_output.append(' | '.join(token))
+        tag_output, tag_probs = decode_tags(torch.sigmoid(logits), self.class_threshold, self.tag_keep, self.tag_list)
+        if return_probs:
+            return tag_output, tag_probs
 
         return tag_output
 
@@ -258,7 +303,9 @@ class RAM(nn.Module):
 def ram(pretrained='', **kwargs):
     model = RAM(**kwargs)
     if pretrained:
-        if kwargs['vit'] == 'swin_b':
+        if is_converted_checkpoint(pretrained):
+            model, msg = load_converted_checkpoint(model, pretrained)
+        elif kwargs['vit'] == 'swin_b':
             model, msg = load_checkpoint_swinbase(model, pretrained, kwargs)
         elif kwargs['vit'] == 'swin_l':
             model, msg = load_checkpoint_swinlarge(model, pretrained, kwargs)
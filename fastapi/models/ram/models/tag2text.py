@@ -91,6 +91,10 @@ class Tag2Text(nn.Module):
         self.delete_tag_index = delete_tag_index
         self.prompt = prompt
         self.prompt_length = len(self.tokenizer(self.prompt).input_ids) - 1
+        # decoder input ids of the prompt, tokenized once here instead of on every generate call
+        prompt_input_ids = self.tokenizer(self.prompt, return_tensors="pt").input_ids
+        prompt_input_ids[:, 0] = self.tokenizer.bos_token_id
+        self.register_buffer('prompt_input_ids', prompt_input_ids[:, :-1], persistent=False)
 
         # load tag list
         self.tag_list = self.load_tag_list(tag_list)
@@ -121,9 +125,15 @@ class Tag2Text(nn.Module):
         # default threshold: 0.68
         # 2701: "person"; 2828: "man"; 1167: "woman"; 
         tag_thrshold = {2701:0.7, 2828: 0.7, 1167: 0.7}
-        self.class_threshold = torch.ones(self.num_class) * self.threshold
+        class_threshold = torch.ones(self.num_class) * self.threshold
         for key,value in tag_thrshold.items():
-            self.class_threshold[key] = value
+            class_threshold[key] = value
+        # buffers follow the model to its device, they are not part of the checkpoint
+        self.register_buffer('class_threshold', class_threshold, persistent=False)
+        # delete some tags that may disturb captioning
+        tag_keep = torch.ones(self.num_class, dtype=torch.bool)
+        tag_keep[self.delete_tag_index] = False
+        self.register_buffer('tag_keep', tag_keep, persistent=False)
 
     def load_tag_list(self, tag_list_file):
         with open(tag_list_file, 'r') as f:
@@ -237,7 +247,11 @@ class Tag2Text(nn.Module):
                  top_p=0.9,
                  repetition_penalty=1.0,
                  tag_input=None,
-                 return_tag_predict=False):
+                 return_tag_predict=False,
+                 max_time=None):
+        """
+        max_time (float): decoding deadline in seconds, once reached the best caption found so far is returned
+        """
 
         image_embeds = self.visual_encoder(image)
         image_atts = torch.ones(image_embeds.size()[:-1],
@@ -247,7 +261,7 @@ class Tag2Text(nn.Module):
         if tag_input == None:
 
             bs = image_embeds.shape[0]
-            label_embed = self.label_embed.weight.unsqueeze(0).repeat(bs, 1, 1)
+            label_embed = self.label_embed.weight.unsqueeze(0).expand(bs, -1, -1)
             tagging_embed = self.tagging_head(
                 encoder_embeds=label_embed,
                 encoder_hidden_states=image_embeds,
@@ -258,33 +272,11 @@ class Tag2Text(nn.Module):
 
             logits = self.fc(tagging_embed[0])
 
-            targets = torch.where(
-                torch.sigmoid(logits) > self.class_threshold.to(image.device),
-                torch.tensor(1.0).to(image.device),
-                torch.zeros(self.num_class).to(image.device))
+            tag_input, _ = decode_tags(torch.sigmoid(logits), self.class_threshold, self.tag_keep, self.tag_list)
 
-            tag = targets.cpu().numpy()
-
-            # delete some tags that may disturb captioning
-            tag[:, self.delete_tag_index] = 0
-
-            tag_input = []
-            for b in range(bs):
-                index = np.argwhere(tag[b] == 1)
-                token = self.tag_list[index].squeeze(axis=1)
-                tag_input.append(' | '.join(token))
-                
         tag_output = tag_input
 
-        # beam search for text generation(default)
-        if not sample:
-            image_embeds = image_embeds.repeat_interleave(num_beams, dim=0)
-            tag_input_temp = []
-            for tag in tag_input:
-                for i in range(num_beams):
-                    tag_input_temp.append(tag)
-            tag_input = tag_input_temp
-
+        # the tags are encoded once per image, the text decoder broadcasts the result over the beams
         image_atts = torch.ones(image_embeds.size()[:-1],
                                 dtype=torch.long).to(image.device)
 
@@ -308,11 +300,7 @@ class Tag2Text(nn.Module):
         )
 
         # prompt trick for better captioning, followed BLIP
-        prompt = [self.prompt] * image.size(0)
-        input_ids = self.tokenizer(prompt, return_tensors="pt").input_ids.to(
-            image.device)
-        input_ids[:, 0] = self.tokenizer.bos_token_id
-        input_ids = input_ids[:, :-1]
+        input_ids = self.prompt_input_ids.expand(image.size(0), -1)
 
         if sample:
             # nucleus sampling
@@ -330,6 +318,7 @@ class Tag2Text(nn.Module):
                 eos_token_id=self.tokenizer.sep_token_id,
                 pad_token_id=self.tokenizer.pad_token_id,
                 repetition_penalty=1.1,
+                max_time=max_time,
                 **model_kwargs)
         else:
             # beam search (default)
@@ -345,6 +334,7 @@ class Tag2Text(nn.Module):
                 eos_token_id=self.tokenizer.sep_token_id,
                 pad_token_id=self.tokenizer.pad_token_id,
                 repetition_penalty=repetition_penalty,
+                max_time=max_time,
                 **model_kwargs)
 
         captions = []
@@ -360,7 +350,9 @@ class Tag2Text(nn.Module):
 def tag2text(pretrained='', **kwargs):
     model = Tag2Text(**kwargs)
     if pretrained:
-        if kwargs['vit'] == 'swin_b':
+        if is_converted_checkpoint(pretrained):
+            model, msg = load_converted_checkpoint(model, pretrained)
+        elif kwargs['vit'] == 'swin_b':
             model, msg = load_checkpoint_swinbase(model, pretrained, kwargs)
         else:
             model, msg = load_checkpoint(model, pretrained)
@@ -2,10 +2,14 @@ import os
 import json
 import torch
 import math
+import numpy as np
 
 from torch import nn
+from torch.nn.modules.module import _IncompatibleKeys
 from typing import List
 from transformers import BertTokenizer
+from safetensors import safe_open
+from safetensors.torch import save_file
 from urllib.parse import urlparse
 from timm.models.hub import download_cached_file
 from .vit import interpolate_pos_embed
@@ -167,11 +171,89 @@ def create_vit(vit,
     return visual_encoder, vision_width
 
 
+def decode_tags(probs, class_threshold, tag_keep, tag_list):
+    """
+    Turn tag probabilities of shape (bs, num_class) into one ' | ' separated tag string per image, keeping
+    the tags above their class threshold that are not masked out by tag_keep, along with their probabilities.
+    """
+    selected = ((probs > class_threshold) & tag_keep).cpu().numpy()
+    probs = probs.cpu().numpy()
+    rows, cols = np.nonzero(selected)
+    counts = np.bincount(rows, minlength=selected.shape[0])
+    tag_output = []
+    tag_probs = []
+    for b, index in enumerate(np.split(cols, np.cumsum(counts)[:-1])):
+        tag_output.append(' | '.join(tag_list[index]))
+        tag_probs.append(probs[b, index].tolist())
+    return tag_output, tag_probs
+
+
 def is_url(url_or_filename):
     parsed = urlparse(url_or_filename)
     return parsed.scheme in ("http", "https")
 
 
+def is_converted_checkpoint(url_or_filename):
+    return str(url_or_filename).endswith('.safetensors')
+
+
+def save_converted_checkpoint(model, filename):
+    """
+    Save the weights of a loaded model, after all checkpoint post-processing, as a safetensors file
+    that load_converted_checkpoint can memory-map. Tied weights are stored once.
+    """
+    tensors = {}
+    aliases = {}
+    stored = {}  # (data_ptr, shape, stride) -> key the tensor was saved under
+    for key, tensor in model.state_dict().items():
+        ref = (tensor.data_ptr(), tuple(tensor.shape), tensor.stride())
+        if ref in stored:
+            aliases[key] = stored[ref]
+            continue
+        stored[ref] = key
+        tensors[key] = tensor.detach().cpu().contiguous()
+    save_file(tensors, filename, metadata={'aliases': json.dumps(aliases)})
+    print('save converted checkpoint to %s' % filename)
+
+
+def load_converted_checkpoint(model, filename):
+    """
+    Load a file written by save_converted_checkpoint without copying it into memory.
+
+    The parameters and buffers of the model are replaced by tensors mapped from the file, so pages are
+    read on first use and processes loading the same file share one physical copy through the page cache.
+    The mapping is private: writing to a weight copies the touched page instead of changing the file.
+    Parameters are frozen (requires_grad=False), the converted weights are meant for inference.
+    """
+    with safe_open(filename, framework='pt', device='cpu') as f:
+        aliases = json.loads((f.metadata() or {}).get('aliases', '{}'))
+        tensors = {key: f.get_tensor(key) for key in f.keys()}
+    for alias, key in aliases.items():
+        tensors[alias] = tensors[key]
+
+    missing_keys = []
+    parameters = {}  # id(tensor) -> Parameter, tied weights get the same Parameter back
+    for key, current in model.state_dict(keep_vars=True).items():
+        if key not in tensors:
+            missing_keys.append(key)
+            continue
+        tensor = tensors.pop(key)
+        if tensor.shape != current.shape:
+            raise RuntimeError(f'size mismatch for {key}: checkpoint {tuple(tensor.shape)}, model {tuple(current.shape)}')
+        module_name, _, name = key.rpartition('.')
+        module = model.get_submodule(module_name)
+        if name in module._parameters:
+            if id(tensor) not in parameters:
+                parameters[id(tensor)] = nn.Parameter(tensor, requires_grad=False)
+            module._parameters[name] = parameters[id(tensor)]
+        else:
+            module._buffers[name] = tensor
+
+    msg = _IncompatibleKeys(missing_keys, list(tensors.keys()))
+    print('load converted checkpoint from %s' % filename)
+    return model, msg
+
+
 def load_checkpoint(model, url_or_filename):
     if is_url(url_or_filename):
         cached_file = download_cached_file(url_or_filename,
@@ -233,6 +315,12 @@ def load_checkpoint_swinbase(model, url_or_filename, kwargs):
             state_dict[k.replace("vision_multi",
                                  "tagging_head")] = state_dict.pop(k)
 
+    # drop weights of modules the model was built without (e.g. inference_only RAM) instead of keeping them around
+    model_keys = model.state_dict().keys()
+    for k in list(state_dict.keys()):
+        if k not in model_keys:
+            del state_dict[k]
+
     msg = model.load_state_dict(state_dict, strict=False)
     print('load checkpoint from %s' % url_or_filename)
     return model, msg
@@ -271,6 +359,12 @@ def load_checkpoint_swinlarge(model, url_or_filename, kwargs):
             state_dict[k.replace("vision_multi",
                                  "tagging_head")] = state_dict.pop(k)
 
+    # drop weights of modules the model was built without (e.g. inference_only RAM) instead of keeping them around
+    model_keys = model.state_dict().keys()
+    for k in list(state_dict.keys()):
+        if k not in model_keys:
+            del state_dict[k]
+
     msg = model.load_state_dict(state_dict, strict=False)
     print('load checkpoint from %s' % url_or_filename)
     return model, msg
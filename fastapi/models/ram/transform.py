@@ -1,6 +1,9 @@
+from functools import lru_cache
+
 from torchvision.transforms import Normalize, Compose, Resize, ToTensor
 
 
+@lru_cache(maxsize=None)
 def get_transform(image_size=384):
     return Compose([
         lambda image: image.convert("RGB"),
@@ -1,6 +1,10 @@
 from transformers import AlignProcessor, AlignModel
 
+import torch
+
 class ALIGNManager:
+    MODEL_VERSION = "kakaobrain/align-base"
+
     def __init__(self, device):
         """
         Initializes an ALIGNManager instance.
@@ -10,11 +14,9 @@ class ALIGNManager:
 
         This constructor initializes the ALIGN model and processor using the specified device.
         """
-        MODEL_VERSION = "kakaobrain/align-base"
-
         self.device = device
-        self.model = AlignModel.from_pretrained(MODEL_VERSION).to(device)
-        self.processor = AlignProcessor.from_pretrained(MODEL_VERSION)
+        self.model = AlignModel.from_pretrained(self.MODEL_VERSION).to(device).eval()
+        self.processor = AlignProcessor.from_pretrained(self.MODEL_VERSION)
 
     def get_model_info(self):
         """
@@ -37,35 +39,92 @@ class ALIGNManager:
 
         This method takes a single text input, processes it using the ALIGN processor, and returns the corresponding text embedding.
         """
+        return self.get_text_embeddings([text])
+    
+    def get_single_image_embedding(self, my_image):
+        """
+        Get the image embedding for a single image input.
+
+        Args:
+        - my_image (numpy.ndarray): The input image for which the embedding should be generated.
+
+        Returns:
+        - numpy.ndarray: A NumPy array containing the image embedding.
+
+        This method takes a single image input, processes it using the ALIGN processor, and returns the corresponding image embedding.
+        """
+        return self.get_image_embeddings([my_image])
+
+    @torch.inference_mode()
+    def get_text_embeddings(self, texts: list, max_length: int = None):
+        """
+        Get the text embeddings for a batch of text inputs in a single forward pass.
+
+        Args:
+        - texts (List[str]): The input texts for which the embeddings should be generated.
+        - max_length (int, optional): Truncate texts to this many tokens, e.g. for long documents. Texts are not truncated by default.
+
+        Returns:
+        - numpy.ndarray: A NumPy array of shape (len(texts), embedding_dim), one row per input text.
+
+        Texts are padded to the longest text in the batch; padded positions are masked out, so each row matches the
+        embedding the text would get on its own.
+        """
+        truncation = {'truncation': True, 'max_length': max_length} if max_length is not None else {}
         inputs = self.processor(
-                text = text,
+                text = texts,
                 images = None,
-                return_tensors="pt"
+                padding = True,
+                return_tensors="pt",
+                **truncation
                 ).to(self.device)
         text_embeddings = self.model.get_text_features(
             input_ids=inputs['input_ids'],
             attention_mask=inputs['attention_mask'],
             token_type_ids=inputs['token_type_ids']
         )
-        return text_embeddings.cpu().detach().numpy()
-    
-    def get_single_image_embedding(self, my_image):
+        return text_embeddings.cpu().numpy()
+
+    def get_image_embeddings(self, images: list):
         """
-        Get the image embedding for a single image input.
+        Get the image embeddings for a batch of image inputs in a single forward pass.
 
         Args:
-        - my_image (numpy.ndarray): The input image for which the embedding should be generated.
+        - images (List[PIL.Image]): The input images for which the embeddings should be generated.
 
         Returns:
-        - numpy.ndarray: A NumPy array containing the image embedding.
+        - numpy.ndarray: A NumPy array of shape (len(images), embedding_dim), one row per input image.
+        """
+        return self.get_pixel_embeddings(self.preprocess_images(images))
 
-        This method takes a single image input, processes it using the ALIGN processor, and returns the corresponding image embedding.
+    def preprocess_images(self, images: list):
         """
-        image = self.processor(
+        Resize and normalize images the way the ALIGN image encoder expects them.
+
+        Args:
+        - images (List[PIL.Image]): The input images.
+
+        Returns:
+        - torch.Tensor: Pixel values of shape (len(images), 3, height, width), on the CPU.
+
+        Preprocessing is split from the forward pass so it can run on the caller's thread, e.g. while a batch of other images is being embedded.
+        """
+        return self.processor(
                 text = None,
-                images = my_image,
+                images = images,
                 return_tensors="pt"
-                )["pixel_values"].to(self.device)
-        
-        image_embedding = self.model.get_image_features(image)
-        return image_embedding.cpu().detach().numpy()
+                )["pixel_values"]
+
+    @torch.inference_mode()
+    def get_pixel_embeddings(self, pixel_values):
+        """
+        Get the image embeddings for a batch of preprocessed images in a single forward pass.
+
+        Args:
+        - pixel_values (torch.Tensor): Output of preprocess_images, or several of its rows stacked together.
+
+        Returns:
+        - numpy.ndarray: A NumPy array of shape (len(pixel_values), embedding_dim), one row per input image.
+        """
+        image_embeddings = self.model.get_image_features(pixel_values.to(self.device))
+        return image_embeddings.cpu().numpy()
@@ -0,0 +1,115 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class BatchScheduler:
+    """
+    Coalesces concurrent single-item inference requests into batched forwards.
+
+    Each job kind (e.g. 'text', 'image', 'caption') has its own queue and worker thread. A worker waits for
+    the first pending item, keeps collecting items of the same kind until either the batching window has
+    elapsed or max_batch_size items are queued, runs the kind's handler once on the whole batch and hands
+    every result back to the request that submitted it. If the handler fails on a batch, its items are run again
+    one at a time, so only the items that fail on their own get the error.
+
+    Threads do not survive a fork, so a forked child (e.g. a preforked server worker) gets fresh queues and
+    worker threads of its own.
+
+    Args:
+        handlers (Dict[str, Callable[[list], list]]): Maps a job kind to a function taking a list of inputs
+            and returning a list of outputs in the same order.
+        window_ms (float): How long to wait for more items after the first one arrives, in milliseconds.
+        max_batch_size (int): Upper bound on the number of items run in one forward.
+
+    Example:
+        scheduler = BatchScheduler({'text': align_model.get_text_embeddings}, window_ms=5, max_batch_size=16)
+        embedding = scheduler.run('text', "a dog standing next to an orange cat")
+    """
+
+    def __init__(self, handlers: dict, window_ms: float = 5, max_batch_size: int = 16):
+        self.handlers = handlers
+        self.window = window_ms / 1000
+        self.max_batch_size = max(1, max_batch_size)
+
+        self._start()
+        os.register_at_fork(after_in_child=self._start)
+
+    def _start(self) -> None:
+        self._queues = {kind: queue.Queue() for kind in self.handlers}
+        self._workers = []
+        for kind in self.handlers:
+            worker = threading.Thread(target=self._worker, args=(kind,), name=f"batch-{kind}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, kind: str, item) -> Future:
+        """
+        Queue a single item and return a future resolving to its output.
+
+        Args:
+        - kind (str): Job kind, one of the keys of the handlers dict.
+        - item: Input for the handler.
+
+        Returns:
+        - concurrent.futures.Future: Future holding the handler's output for this item.
+        """
+        if kind not in self._queues:
+            raise KeyError(f"Unknown job kind: {kind}")
+        future = Future()
+        self._queues[kind].put((item, future))
+        return future
+
+    def run(self, kind: str, item):
+        """
+        Queue a single item and block until its output is ready.
+        """
+        return self.submit(kind, item).result()
+
+    def _collect(self, kind: str) -> list:
+        """
+        Block for the first item of a kind, then gather more until the window closes or the batch is full.
+        """
+        jobs = self._queues[kind]
+        batch = [jobs.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(jobs.get(timeout=remaining) if remaining > 0 else jobs.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _worker(self, kind: str) -> None:
+        handler = self.handlers[kind]
+        while True:
+            batch = self._collect(kind)
+            # Drop requests whose caller has already given up
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                outputs = handler([item for item, _ in batch])
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                else:
+                    self._run_one_by_one(handler, batch)
+                continue
+            for (_, future), output in zip(batch, outputs):
+                future.set_result(output)
+
+    def _run_one_by_one(self, handler, batch: list) -> None:
+        """
+        Run the items of a failed batch separately, so one bad item does not fail the requests it was batched with.
+        """
+        for item, future in batch:
+            try:
+                output = handler([item])[0]
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            future.set_result(output)
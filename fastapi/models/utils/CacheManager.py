@@ -0,0 +1,149 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheManager:
+    """
+    Thread-safe LRU cache with an optional time-to-live and an optional on-disk tier.
+
+    Entries live in memory up to max_size, evicting the least recently used one. With a disk path, every
+    entry is also written to an SQLite file so it survives restarts; a memory miss falls back to the disk
+    tier and promotes the entry back into memory. A forked child keeps the entries in memory and opens its
+    own connection to the disk tier. The disk tier is best-effort: if SQLite fails (e.g. the file is locked
+    by another worker) the error is printed and the cache behaves as if it was memory-only for that call.
+
+    Args:
+        max_size (int): Maximum number of entries kept in memory.
+        ttl (float): Seconds after which an entry expires. 0 keeps entries until they are evicted.
+        disk_path (str, optional): SQLite file for the on-disk tier. No disk tier if None.
+        max_disk_size (int): Maximum number of entries kept on disk, oldest are dropped first.
+
+    Example:
+        cache = CacheManager(max_size=1024, ttl=3600)
+        embedding = cache.get(key)
+        if embedding is None:
+            embedding = compute(key)
+            cache.set(key, embedding)
+    """
+
+    PRUNE_EVERY = 100 # disk writes between two size checks of the disk tier
+
+    def __init__(self, max_size: int = 1024, ttl: float = 0, disk_path: str = None, max_disk_size: int = 100000):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_disk_size = max_disk_size
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict() # key -> (created, value)
+
+        self.disk_path = disk_path
+        self._disk_writes = 0
+        self._connect()
+        os.register_at_fork(after_in_child=self._connect)
+
+    def _connect(self) -> None:
+        # Locks and SQLite connections must not be shared across a fork, each process gets its own.
+        # _lock guards the memory tier, _disk_lock the connection, so disk I/O never blocks memory hits.
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._disk = None
+        if not self.disk_path:
+            return
+        try:
+            self._disk = sqlite3.connect(self.disk_path, check_same_thread=False)
+            self._disk.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, created REAL)")
+            self._disk.commit()
+        except sqlite3.Error as e:
+            print(f"Cache disk tier {self.disk_path} unavailable, caching in memory only: {e}")
+            self._disk = None
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    def _remember(self, key: str, created: float, value) -> None:
+        self._entries[key] = (created, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get(self, key: str):
+        """
+        Return the cached value for key, or None if it is missing or expired.
+        """
+        with self._lock:
+            if key in self._entries:
+                created, value = self._entries[key]
+                if not self._expired(created):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+            if self._disk is None:
+                self.misses += 1
+                return None
+
+        row = self._read(key)
+        with self._lock:
+            if row is not None and not self._expired(row[1]):
+                value = pickle.loads(row[0])
+                self._remember(key, row[1], value)
+                self.disk_hits += 1
+                return value
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value) -> None:
+        """
+        Cache value under key, in memory and on disk if there is a disk tier.
+        """
+        created = time.time()
+        with self._lock:
+            self._remember(key, created, value)
+        if self._disk is not None:
+            self._write(key, created, pickle.dumps(value))
+
+    def _read(self, key: str):
+        with self._disk_lock:
+            try:
+                return self._disk.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+            except sqlite3.Error as e:
+                print(f"Cache disk read failed, treating as a miss: {e}")
+                return None
+
+    def _write(self, key: str, created: float, blob: bytes) -> None:
+        with self._disk_lock:
+            try:
+                self._disk.execute("INSERT OR REPLACE INTO cache (key, value, created) VALUES (?, ?, ?)", (key, blob, created))
+                self._disk_writes += 1
+                if self._disk_writes % self.PRUNE_EVERY == 0:
+                    self._disk.execute(
+                        "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                        (self.max_disk_size,)
+                    )
+                self._disk.commit()
+            except sqlite3.Error as e:
+                # Don't leave a half-done transaction holding the file lock against the other workers
+                print(f"Cache disk write failed, kept in memory only: {e}")
+                try:
+                    self._disk.rollback()
+                except sqlite3.Error:
+                    pass
+
+    def stats(self) -> dict:
+        """
+        Return the hit/miss counters and the number of entries in memory.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+            }
@@ -0,0 +1,38 @@
+import threading
+
+
+class ModelLoader:
+    """
+    Loads a model the first time it is needed and keeps it for later calls.
+
+    Loading is thread-safe: concurrent first calls wait for a single load instead of each loading a copy.
+
+    Args:
+        name (str): Name used in log messages.
+        load (Callable[[], Any]): Function building and returning the model.
+
+    Example:
+        align_loader = ModelLoader('align', lambda: ALIGNManager(device))
+        align_model = align_loader.get()
+    """
+
+    def __init__(self, name: str, load):
+        self.name = name
+        self._load = load
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    def get(self):
+        """
+        Return the model, loading it first if needed.
+        """
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = self._load()
+                    print(f"Loaded {self.name} model")
+        return self._model
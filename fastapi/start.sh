@@ -0,0 +1,8 @@
+#!/bin/sh
+# FASTAPI_WORKERS=0 runs a single auto-reloading uvicorn process for development,
+# otherwise the models are loaded once and that many workers are forked from gunicorn (see gunicorn_conf.py).
+if [ "${FASTAPI_WORKERS:-0}" -gt 0 ]; then
+    exec gunicorn main:app -c gunicorn_conf.py
+else
+    exec uvicorn main:app --reload --host 0.0.0.0 --port 8000
+fi